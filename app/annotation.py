@@ -0,0 +1,240 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from app.io_utils import tmp_path, replace_path
+
+
+class AnnotationIndex:
+    """MITE annotation of a single chromosome prepared for vectorized classification of k-mer occurrences.
+
+    MITEs are kept as begin/end arrays sorted in two orders together with prefix sums of their ids. For any
+    set of window positions the number of overlapping MITEs (and the id of the MITE if there is only one) is
+    then found with binary searches, without any interval tree queries."""
+
+    ARRAYS = ['begins', 'ends', 'families', 'begin_order', 'sorted_begins', 'begin_id_cumsum', 'sorted_ends', 'end_id_cumsum']
+
+    def __init__(self, begins, ends, families, family_names):
+        begins = np.asarray(begins, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        families = np.asarray(families, dtype=np.int32)
+
+        # Identical MITEs are stored only once and empty intervals are ignored, as in the interval tree
+        intervals = np.unique(np.stack((begins, ends, families.astype(np.int64)), axis=1).reshape(-1, 3), axis=0)
+        intervals = intervals[intervals[:, 0] < intervals[:, 1]]
+
+        self.begins = intervals[:, 0]
+        self.ends = intervals[:, 1]
+        self.families = intervals[:, 2].astype(np.int32)
+
+        ids = np.arange(len(self.begins), dtype=np.int64)
+        self.begin_order = np.argsort(self.begins, kind='stable')
+        self.sorted_begins = self.begins[self.begin_order]
+        self.begin_id_cumsum = np.concatenate(([0], np.cumsum(ids[self.begin_order] + 1)))
+
+        end_order = np.argsort(self.ends, kind='stable')
+        self.sorted_ends = self.ends[end_order]
+        self.end_id_cumsum = np.concatenate(([0], np.cumsum(ids[end_order] + 1)))
+
+        self.max_mite_length = int((self.ends - self.begins).max()) if len(self.begins) else 0
+        self.set_columns(family_names)
+
+    def set_columns(self, family_names):
+        self.family_names = list(family_names)
+
+        self.column_names = sorted(self.family_names + [f'{name}_edge' for name in self.family_names]) + ["edge", "genome"]
+        column_index = {name: i for i, name in enumerate(self.column_names)}
+        self.family_columns = np.array([column_index[name] for name in self.family_names], dtype=np.int64)
+        self.family_edge_columns = np.array([column_index[f'{name}_edge'] for name in self.family_names], dtype=np.int64)
+        self.edge_column = column_index["edge"]
+        self.genome_column = column_index["genome"]
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays, family_names):
+        """Rebuilds an index from the arrays of another one (e.g. views of a shared memory block) without copying
+        or sorting them again"""
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+
+        index.max_mite_length = int((index.ends - index.begins).max()) if len(index.begins) else 0
+        index.set_columns(family_names)
+
+        return index
+
+    def overlapping_mites(self, positions, kmer_length):
+        """Returns the MITEs overlapping the windows [position, position + kmer_length] as a tuple of arrays:
+        the number of overlapping MITEs and the id of the MITE (-1 if the number is not equal to 1)."""
+        began = np.searchsorted(self.sorted_begins, positions + kmer_length, side='right')
+        ended = np.searchsorted(self.sorted_ends, positions, side='right')
+
+        overlaps = began - ended
+        mite_ids = self.begin_id_cumsum[began] - self.end_id_cumsum[ended] - 1
+        mite_ids[overlaps != 1] = -1
+
+        return overlaps, mite_ids
+
+    def mites_at(self, position, kmer_length):
+        """Returns ids of all MITEs overlapping a single window"""
+        first = np.searchsorted(self.sorted_begins, position - self.max_mite_length, side='right')
+        last = np.searchsorted(self.sorted_begins, position + kmer_length, side='right')
+        candidates = self.begin_order[first:last]
+
+        return candidates[self.ends[candidates] > position]
+
+    def classify(self, positions, kmer_length):
+        """Classifies k-mer occurrences starting at the given positions.
+
+        Returns a tuple (occurrences, columns, inside, inside_mites, multiple), where every pair
+        (occurrences[i], columns[i]) is a single count of the occurrence in a table column, inside holds the
+        occurrences located entirely within a MITE together with ids of those MITEs in inside_mites, and
+        multiple holds the occurrences overlapping more than one MITE.
+
+        An occurrence overlapping several MITEs is an edge hit of every one of them. The interval tree worker did
+        this for two MITEs but stopped the whole run with exit(1) for more than two; such occurrences are counted
+        the same way now and reported as 'intTree>2' lines of the chromosome log."""
+        positions = np.asarray(positions, dtype=np.int64)
+        overlaps, mite_ids = self.overlapping_mites(positions, kmer_length)
+
+        single = np.flatnonzero(overlaps == 1)
+        single_mites = mite_ids[single]
+        is_inside = (positions[single] >= self.begins[single_mites] - 1) & \
+                    (positions[single] + kmer_length <= self.ends[single_mites])
+
+        inside = single[is_inside]
+        inside_mites = single_mites[is_inside]
+        edge = single[~is_inside]
+        edge_mites = single_mites[~is_inside]
+        genome = np.flatnonzero(overlaps == 0)
+        multiple = np.flatnonzero(overlaps > 1)
+
+        multiple_occurrences = []
+        multiple_mites = []
+        for occurrence in multiple.tolist():
+            mites = self.mites_at(positions[occurrence], kmer_length)
+            multiple_occurrences.append(np.full(len(mites), occurrence, dtype=np.int64))
+            multiple_mites.append(mites)
+
+        if multiple_occurrences:
+            edge = np.concatenate([edge] + multiple_occurrences)
+            edge_mites = np.concatenate([edge_mites] + multiple_mites)
+
+        occurrences = np.concatenate((genome, inside, edge, edge))
+        columns = np.concatenate((
+            np.full(len(genome), self.genome_column, dtype=np.int64),
+            self.family_columns[self.families[inside_mites]],
+            np.full(len(edge), self.edge_column, dtype=np.int64),
+            self.family_edge_columns[self.families[edge_mites]]
+        ))
+
+        return occurrences, columns, inside, inside_mites, multiple
+
+
+class AnnotationStore:
+    """MITE annotation of the whole genome built once per run.
+
+    MITEs are kept in arrays sorted by chromosome and position (CSR layout: MITEs of the i-th chromosome are
+    stored between chromosome_offsets[i] and chromosome_offsets[i + 1]) together with the MITE family names
+    and total lengths of the families. The store is cached on disk and memory-mapped by every worker."""
+
+    ARRAYS = ['chromosome_offsets', 'begins', 'ends', 'families', 'family_lengths']
+
+    def __init__(self, chromosomes, chromosome_offsets, begins, ends, families, family_names, family_lengths):
+        self.chromosomes = list(chromosomes)
+        self.chromosome_offsets = chromosome_offsets
+        self.begins = begins
+        self.ends = ends
+        self.families = families
+        self.family_names = list(family_names)
+        self.family_lengths = family_lengths
+
+    @classmethod
+    def from_bed(cls, bed_file):
+        bed = pd.read_csv(bed_file, sep='\t', header=None, usecols=[0, 1, 2, 3], names=['chr', 'begin', 'end', 'family'],
+                          dtype={'chr': str, 'begin': np.int64, 'end': np.int64, 'family': str})
+
+        chromosome_ids, chromosomes = pd.factorize(bed['chr'])
+        families, family_names = pd.factorize(bed['family'])
+        begins = bed['begin'].to_numpy()
+        ends = bed['end'].to_numpy()
+
+        family_lengths = np.zeros(len(family_names), dtype=np.int64)
+        np.add.at(family_lengths, families, ends - begins + 1)
+
+        order = np.lexsort((begins, chromosome_ids))
+        chromosome_offsets = np.searchsorted(chromosome_ids[order], np.arange(len(chromosomes) + 1))
+
+        return cls(chromosomes, chromosome_offsets, begins[order], ends[order], families[order].astype(np.int32),
+                   family_names, family_lengths)
+
+    def save(self, store_dir):
+        os.mkdir(store_dir)
+
+        for name in self.ARRAYS:
+            np.save(os.path.join(store_dir, f'{name}.npy'), getattr(self, name))
+
+        with open(os.path.join(store_dir, 'chromosomes.txt'), 'w') as file:
+            file.write("".join(f'{name}\n' for name in self.chromosomes))
+
+        with open(os.path.join(store_dir, 'families.txt'), 'w') as file:
+            file.write("".join(f'{name}\n' for name in self.family_names))
+
+    @classmethod
+    def load(cls, store_dir):
+        arrays = {name: np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode='r') for name in cls.ARRAYS}
+
+        with open(os.path.join(store_dir, 'chromosomes.txt'), 'r') as file:
+            chromosomes = file.read().splitlines()
+
+        with open(os.path.join(store_dir, 'families.txt'), 'r') as file:
+            family_names = file.read().splitlines()
+
+        return cls(chromosomes, arrays['chromosome_offsets'], arrays['begins'], arrays['ends'], arrays['families'],
+                   family_names, arrays['family_lengths'])
+
+    @staticmethod
+    def cache_path(bed_file, cache_dir):
+        """Returns the cache directory of a BED file, keyed on the file content and its modification time"""
+        digest = hashlib.sha256()
+
+        with open(bed_file, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+
+        digest.update(str(os.stat(bed_file).st_mtime_ns).encode())
+
+        return os.path.join(cache_dir, f'annotation_{digest.hexdigest()[:16]}')
+
+    @classmethod
+    def open(cls, bed_file, cache_dir):
+        """Loads the annotation of a BED file from the cache, building and caching it first if needed.
+
+        Returns a tuple (store, store_dir)."""
+        store_dir = cls.cache_path(bed_file, cache_dir)
+
+        if not os.path.exists(store_dir):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            # The store is built in a temporary directory, so a partially written store is never loaded
+            tmp_dir = tmp_path(store_dir)
+            cls.from_bed(bed_file).save(tmp_dir)
+            replace_path(tmp_dir, store_dir)
+
+        return cls.load(store_dir), store_dir
+
+    def index(self, chr_name):
+        """Returns the AnnotationIndex of a chromosome (empty if the chromosome has no MITEs)"""
+        if chr_name in self.chromosomes:
+            i = self.chromosomes.index(chr_name)
+            first, last = self.chromosome_offsets[i], self.chromosome_offsets[i + 1]
+        else:
+            first, last = 0, 0
+
+        return AnnotationIndex(self.begins[first:last], self.ends[first:last], self.families[first:last], self.family_names)
+
+    def family_total_lengths(self):
+        return dict(zip(self.family_names, self.family_lengths.tolist()))
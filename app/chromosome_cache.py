@@ -0,0 +1,125 @@
+import struct
+import numpy as np
+from app.kmer_codes import encode_sequence, INVALID_BASE
+from app.io_utils import tmp_path, replace_path
+
+# Layout of a chromosome cache file:
+#   header    - magic, chromosome length, number of N-runs, offset of the N-runs table
+#   sequence  - one byte per base (A=0, C=1, G=2, T=3, any other character=4)
+#   N-runs    - int64 (start, end) pairs of runs of non-ACGT characters, aligned to 8 bytes
+CACHE_MAGIC = b'KMCHROM1'
+CACHE_HEADER = struct.Struct('<8sQQQ')
+READ_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Composition classes of sequence characters: 0 - upper-case ACGT, 1 - soft-masked (lower-case acgt), 2 - others
+COMPOSITION_TABLE = np.full(256, 2, dtype=np.uint8)
+COMPOSITION_TABLE[np.frombuffer(b'ACGT', dtype=np.uint8)] = 0
+COMPOSITION_TABLE[np.frombuffer(b'acgt', dtype=np.uint8)] = 1
+
+
+def invalid_runs(encoded, offset=0):
+    """Returns (start, end) pairs of runs of non-ACGT positions in an encoded sequence"""
+    invalid = np.concatenate(([False], encoded >= INVALID_BASE, [False])).view(np.int8)
+    bounds = np.flatnonzero(np.diff(invalid)).reshape(-1, 2)
+
+    return bounds.astype(np.int64) + offset
+
+
+def merge_runs(runs):
+    """Joins runs that touch each other (e.g. runs split between two read chunks)"""
+    if len(runs) < 2:
+        return runs
+
+    keep = runs[1:, 0] != runs[:-1, 1]
+    return np.stack((runs[np.concatenate(([True], keep)), 0], runs[np.concatenate((keep, [True])), 1]), axis=1)
+
+
+class ChromosomeCacheWriter:
+    """Writes a chromosome cache file from sequence chunks (without new line characters) as they arrive"""
+
+    def __init__(self, cache_file_path):
+        self.cache_file_path = cache_file_path
+        self.tmp_file_path = tmp_path(cache_file_path)
+        self.length = 0
+        self.runs = []
+        self.composition = np.zeros(3, dtype=np.int64)
+
+        self.file = open(self.tmp_file_path, 'wb')
+        self.file.write(CACHE_HEADER.pack(CACHE_MAGIC, 0, 0, 0))
+
+    def write(self, sequence):
+        self.composition += np.bincount(COMPOSITION_TABLE[np.frombuffer(sequence, dtype=np.uint8)], minlength=3)
+        encoded = encode_sequence(sequence)
+        self.runs.append(invalid_runs(encoded, self.length))
+        self.file.write(encoded.tobytes())
+        self.length += len(encoded)
+
+    def close(self):
+        """Completes the cache file. Returns the composition of the chromosome: a dictionary with its length, the
+        number of ambiguous positions (n_count, any character other than ACGT or acgt) and the number of
+        soft-masked bases."""
+        runs = merge_runs(np.concatenate(self.runs) if self.runs else np.zeros((0, 2), dtype=np.int64))
+
+        runs_offset = CACHE_HEADER.size + self.length
+        runs_offset += -runs_offset % 8
+        self.file.write(b'\0' * (runs_offset - CACHE_HEADER.size - self.length))
+        self.file.write(runs.astype('<i8').tobytes())
+
+        self.file.seek(0)
+        self.file.write(CACHE_HEADER.pack(CACHE_MAGIC, self.length, len(runs), runs_offset))
+        self.file.close()
+
+        # The cache appears under its final name only when it is complete
+        replace_path(self.tmp_file_path, self.cache_file_path)
+
+        return {'length': self.length, 'n_count': int(self.composition[2]), 'soft_masked': int(self.composition[1])}
+
+
+def write_chromosome_cache(oneline_file_path, cache_file_path):
+    """Packs a '*_oneLine.txt' chromosome into the binary cache file, reading it in fixed-size chunks.
+    Returns the composition of the chromosome (see ChromosomeCacheWriter.close)."""
+    writer = ChromosomeCacheWriter(cache_file_path)
+
+    with open(oneline_file_path, 'rb') as file_in:
+        while True:
+            chunk = file_in.read(READ_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+
+            writer.write(chunk.replace(b'\n', b'').replace(b'\r', b''))
+
+    return writer.close()
+
+
+def read_cache_header(cache_file_path):
+    with open(cache_file_path, 'rb') as file:
+        magic, length, runs_number, runs_offset = CACHE_HEADER.unpack(file.read(CACHE_HEADER.size))
+
+    if magic != CACHE_MAGIC:
+        raise ValueError(f'{cache_file_path} is not a chromosome cache file')
+
+    return length, runs_number, runs_offset
+
+
+def read_chromosome_length(cache_file_path):
+    return read_cache_header(cache_file_path)[0]
+
+
+def open_chromosome_cache(cache_file_path):
+    """Memory-maps a chromosome cache file.
+
+    Returns a tuple (sequence, n_runs) of read-only arrays. Pages are shared through the OS page cache,
+    so workers opening the same chromosome do not hold private copies of it."""
+    length, runs_number, runs_offset = read_cache_header(cache_file_path)
+
+    if length:
+        sequence = np.memmap(cache_file_path, dtype=np.uint8, mode='r', offset=CACHE_HEADER.size, shape=(length,))
+    else:
+        sequence = np.zeros(0, dtype=np.uint8)
+
+    if runs_number:
+        n_runs = np.memmap(cache_file_path, dtype='<i8', mode='r', offset=runs_offset, shape=(runs_number, 2))
+    else:
+        n_runs = np.zeros((0, 2), dtype=np.int64)
+
+    return sequence, n_runs
@@ -0,0 +1,84 @@
+import os
+import shutil
+import numpy as np
+from app.io_utils import atomic_dir, write_meta, read_meta
+from app.kmer_codes import codes_to_kmers
+from app.occurrence_index import write_shard_run, join_shard_runs
+
+# Coordinates of k-mers found inside MITEs are kept per chromosome in a directory:
+#   records.bin - int64 (begin, end, family) records of the MITEs holding the k-mers, sorted by k-mer code
+#   codes.bin   - uint64 distinct k-mer codes, sorted
+#   offsets.bin - int64 offset index: records of the i-th k-mer are stored between offsets[i] and offsets[i + 1],
+#                 so a k-mer is read with a single seek to the byte range [offsets[i] * 24, offsets[i + 1] * 24)
+#   families.txt - MITE family names, one per line
+#   meta.txt    - 'key=value' lines: kmer_length, chr_name, kmers and records
+# Shards save their records as sorted runs (see write_coords_run), which the reducer joins into the index, so
+# coordinates of a chromosome are never held in memory at once.
+RECORD_FIELDS = 3
+
+
+def write_coords_run(run_dir, shard_start, codes, begins, ends, families):
+    """Saves coordinates of k-mer occurrences of a shard (codes and begins, ends and families of their MITEs)"""
+    write_shard_run(run_dir, shard_start, codes, np.stack((begins, ends, families), axis=1), '<i8')
+
+
+def build_coords_index(run_dir, path, kmer_length, chr_name, family_names, kmer_codes):
+    """Joins sorted shard runs into saved coordinates of the 'kmer_codes' k-mers. Records of a k-mer keep the
+    order of the shards."""
+    with atomic_dir(path) as tmp_path:
+        codes, offsets = join_shard_runs(run_dir, os.path.join(tmp_path, 'records.bin'), '<i8', kmer_codes)
+        codes.astype('<u8').tofile(os.path.join(tmp_path, 'codes.bin'))
+        offsets.astype('<i8').tofile(os.path.join(tmp_path, 'offsets.bin'))
+
+        with open(os.path.join(tmp_path, 'families.txt'), 'w') as file:
+            file.write("".join(f'{name}\n' for name in family_names))
+
+        write_meta(tmp_path, kmer_length=kmer_length, chr_name=chr_name, kmers=len(codes), records=offsets[-1])
+
+    shutil.rmtree(run_dir)
+
+
+class CoordsIndex:
+    def __init__(self, kmer_length, chr_name, family_names, codes, offsets, records):
+        self.kmer_length = kmer_length
+        self.chr_name = chr_name
+        self.family_names = list(family_names)
+        self.codes = codes
+        self.offsets = offsets
+        self.records = records
+
+    @classmethod
+    def load(cls, path):
+        """Opens saved coordinates. The index is memory-mapped, so only records of the requested k-mers are read."""
+        meta = read_meta(path)
+
+        with open(os.path.join(path, 'families.txt'), 'r') as file:
+            family_names = file.read().splitlines()
+
+        kmers, records = int(meta['kmers']), int(meta['records'])
+        codes = np.memmap(os.path.join(path, 'codes.bin'), dtype='<u8', mode='r', shape=(kmers,)) if kmers else np.zeros(0, dtype=np.uint64)
+        offsets = np.fromfile(os.path.join(path, 'offsets.bin'), dtype='<i8')
+        records = np.memmap(os.path.join(path, 'records.bin'), dtype='<i8', mode='r', shape=(records, RECORD_FIELDS)) \
+            if records else np.zeros((0, RECORD_FIELDS), dtype=np.int64)
+
+        return cls(int(meta['kmer_length']), meta['chr_name'], family_names, codes, offsets, records)
+
+    def write_tsv(self, file, codes=None):
+        """Writes coordinates as 'chromosome, begin, end, k-mer;family' lines, of all k-mers or of the given
+        codes only (in code order). Returns the number of written lines."""
+        if codes is None:
+            selected = np.arange(len(self.codes))
+        else:
+            codes = np.unique(np.asarray(codes, dtype=np.uint64))
+            selected = np.searchsorted(self.codes, codes)
+            found = selected < len(self.codes)
+            found[found] = self.codes[selected[found]] == codes[found]
+            selected = selected[found]
+
+        lines_number = 0
+        for i, kmer in zip(selected.tolist(), codes_to_kmers(self.codes[selected], self.kmer_length)):
+            for begin, end, family in self.records[self.offsets[i]:self.offsets[i + 1]].tolist():
+                file.write(f"{self.chr_name}\t{begin}\t{end}\t{kmer};{self.family_names[family]}\n")
+                lines_number += 1
+
+        return lines_number
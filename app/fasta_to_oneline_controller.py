@@ -1,32 +1,96 @@
 import os
-from app.utils import fasta_to_oneline
+from multiprocessing import Pool
+from app.utils import fasta_to_oneline, find_fasta_file, oneline_to_fasta
+from app.genome_catalog import GenomeCatalog
 from app.text_formating import red, green, print_warning, print_info, print_logo
 
 
+def convert_fasta_file(task):
+    """Converts a single FASTA file. Returns a tuple (prefix, records, checksum, error)."""
+    file_prefix, input_file_path, data_dir = task
+
+    try:
+        records, checksum = fasta_to_oneline(input_file_path, data_dir, file_prefix)
+    except Exception as e:
+        return file_prefix, None, None, e
+
+    return file_prefix, records, checksum, None
+
+
+def outputs_exist(data_dir, prefixes):
+    return all(os.path.exists(os.path.join(data_dir, f'{prefix}_oneLine.txt')) and
+               os.path.exists(os.path.join(data_dir, f'{prefix}_chrom.bin')) for prefix in prefixes)
+
+
 def bulk_fasta_to_oneline(parameters):
+    """Converts FASTA files (plain or gzip-compressed) into oneLine text files and chromosome caches.
+
+    Files are converted in parallel, every record of a multi-record file becomes a chromosome of its own and
+    'prefixes' is updated to list the chromosomes. Every conversion is recorded in the genome catalog of the
+    data directory; a file is converted again only when its outputs are missing or it changed since then."""
     print('')
     print_info('Converting FASTA files to text files.')
 
+    catalog = GenomeCatalog.load(parameters['data_dir'])
+    input_files = {}
+    tasks = []
+
     for file_prefix in parameters['prefixes']:
-        input_file = f'{file_prefix}.fasta'
-        input_file_path = os.path.join(parameters['data_dir'], input_file)
-        output_file = f'{file_prefix}_oneLine.txt'
-        output_file_path = os.path.join(parameters['data_dir'], f'{file_prefix}_oneLine.txt')
+        input_file_path = find_fasta_file(parameters['data_dir'], file_prefix)
+        if input_file_path is None:
+            print_warning(f'There is no FASTA file of the {file_prefix} prefix in the data directory.')
+            return False
+
+        input_files[file_prefix] = input_file_path
+        input_file = os.path.basename(input_file_path)
 
-        if os.path.exists(output_file_path):
-            print_info(f'The output {output_file} file already exists. Skipping ...')
+        if outputs_exist(parameters['data_dir'], catalog.records(input_file_path)) and catalog.is_fresh(input_file_path):
+            print_info(f'The output files of {input_file} are up to date. Skipping ...')
             continue
 
-        print_info(f'Converting {input_file} into {output_file} ... ')
+        print_info(f'Converting {input_file} ... ')
+        tasks.append((file_prefix, input_file_path, parameters['data_dir']))
 
-        try:
-            fasta_to_oneline(input_file_path, output_file_path)
-        except Exception as e:
-            print_warning(f'Something went wrong during saving to the {output_file} file.')
-            print_warning('Please, check the stderr output:\n')
-            print(e)
+    converted = set()
 
-            return False
+    if len(tasks):
+        with Pool(min(int(parameters['threads_number']), len(tasks))) as pool:
+            for file_prefix, records, checksum, error in pool.imap_unordered(convert_fasta_file, tasks):
+                input_file_path = input_files[file_prefix]
+
+                if error is not None:
+                    print_warning(f'Something went wrong during converting the {os.path.basename(input_file_path)} file.')
+                    print_warning('Please, check the stderr output:\n')
+                    print(error)
+
+                    return False
+
+                catalog.remove_source(input_file_path)
+                for name, composition in records:
+                    catalog.update(name, input_file_path, composition, checksum)
+                    converted.add(name)
+
+                catalog.save()
+                print_info(f'{os.path.basename(input_file_path)} converted into {len(records)} chromosome(s)')
+
+    # Refreshed modification times of unchanged files are stored too
+    catalog.save()
+
+    prefixes = [name for file_prefix in parameters['prefixes'] for name in catalog.records(input_files[file_prefix])]
+    if prefixes != parameters['prefixes']:
+        print_info(f'Chromosomes: {", ".join(prefixes)}')
+        parameters['prefixes'] = prefixes
+
+    if parameters.get('counting_backend', 'jellyfish') == 'jellyfish':
+        for name in prefixes:
+            if os.path.basename(catalog.entries[name]['source']) == f'{name}.fasta':
+                continue
+
+            # Compressed and split records are given to jellyfish as single-record FASTA files
+            fasta_file_path = os.path.join(parameters['jellyfish_fasta_dir'], f'{name}.fasta')
+            if name in converted or not os.path.exists(fasta_file_path):
+                print_info(f'Writing {name}.fasta for jellyfish ... ')
+                oneline_to_fasta(os.path.join(parameters['data_dir'], f'{name}_oneLine.txt'), fasta_file_path, name)
 
     print_info("Conversion completed")
 
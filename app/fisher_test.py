@@ -0,0 +1,158 @@
+import os
+import numpy as np
+from scipy.stats import hypergeom
+from app.io_utils import atomic_file
+
+# Relative tolerance used by scipy.stats.fisher_exact to compare probabilities of the tables
+EPSILON = 1e-14
+GAMMA = 1 + EPSILON
+
+
+def binary_search(function, values, lo, hi):
+    """Vectorized binary search of scipy's two-sided Fisher test.
+
+    For every element finds i between lo and hi such that function(i) <= values < function(i + 1), where
+    function(x, elements) is evaluated for the selected elements only."""
+    lo = lo.copy()
+    hi = hi.copy()
+    found = np.zeros(len(lo), dtype=bool)
+    result = np.zeros(len(lo), dtype=np.int64)
+
+    while True:
+        elements = np.flatnonzero(~found & (lo < hi))
+        if len(elements) == 0:
+            break
+
+        mid = lo[elements] + (hi[elements] - lo[elements]) // 2
+        mid_values = function(mid, elements)
+
+        less = mid_values < values[elements]
+        greater = mid_values > values[elements]
+        equal = ~less & ~greater
+
+        lo[elements[less]] = mid[less] + 1
+        hi[elements[greater]] = mid[greater] - 1
+        result[elements[equal]] = mid[equal]
+        found[elements[equal]] = True
+
+    rest = np.flatnonzero(~found)
+    result[rest] = np.where(function(lo[rest], rest) <= values[rest], lo[rest], lo[rest] - 1)
+
+    return result
+
+
+def fisher_exact(c00, c01, c10, c11):
+    """Two-sided Fisher's exact test of many 2x2 tables [[c00, c01], [c10, c11]] at once.
+
+    Follows the algorithm of scipy.stats.fisher_exact step by step, so the p-values are the same as the ones
+    returned for every table separately. Returns an array of p-values."""
+    c00, c01, c10, c11 = [np.asarray(c, dtype=np.int64) for c in (c00, c01, c10, c11)]
+    pvalues = np.ones(len(c00), dtype=np.float64)
+
+    # If both values in a row or column are zero, the p-value is 1
+    tested = np.flatnonzero((c00 + c01 > 0) & (c10 + c11 > 0) & (c00 + c10 > 0) & (c01 + c11 > 0))
+    x = c00[tested]
+    n1 = x + c01[tested]
+    n2 = c10[tested] + c11[tested]
+    n = x + c10[tested]
+    total = n1 + n2
+
+    def pmf(values, elements):
+        return hypergeom.pmf(values, total[elements], n1[elements], n[elements])
+
+    everything = np.arange(len(tested))
+    mode = ((n + 1) * (n1 + 1) / (total + 2)).astype(np.int64)
+    pexact = pmf(x, everything)
+    pmode = pmf(mode, everything)
+    p = np.ones(len(tested), dtype=np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        same = np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= EPSILON
+
+    # Tables in the lower tail of the distribution
+    lower = np.flatnonzero(~same & (x < mode))
+    if len(lower):
+        plower = hypergeom.cdf(x[lower], total[lower], n1[lower], n[lower])
+        single_tail = pmf(n[lower], lower) > pexact[lower] * GAMMA
+        p[lower] = plower
+
+        both = lower[~single_tail]
+        guess = binary_search(lambda values, elements: -pmf(values, both[elements]), -pexact[both] * GAMMA, mode[both], n[both])
+        p[both] = plower[~single_tail] + hypergeom.sf(guess, total[both], n1[both], n[both])
+
+    # Tables in the upper tail of the distribution
+    upper = np.flatnonzero(~same & (x >= mode))
+    if len(upper):
+        pupper = hypergeom.sf(x[upper] - 1, total[upper], n1[upper], n[upper])
+        single_tail = pmf(np.zeros(len(upper), dtype=np.int64), upper) > pexact[upper] * GAMMA
+        p[upper] = pupper
+
+        both = upper[~single_tail]
+        guess = binary_search(lambda values, elements: pmf(values, both[elements]), pexact[both] * GAMMA,
+                              np.zeros(len(both), dtype=np.int64), mode[both])
+        p[both] = pupper[~single_tail] + hypergeom.cdf(guess, total[both], n1[both], n[both])
+
+    pvalues[tested] = np.minimum(p, 1.0)
+
+    return pvalues
+
+
+class PValueCache:
+    """Fisher test p-values memoized on the 2x2 table.
+
+    Identical tables are tested only once and, if a cache file is given, p-values are kept between runs (a
+    p-value depends on the table only, so the cache stays valid when thresholds or inputs change)."""
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.tables = np.zeros((0, 4), dtype=np.int64)
+        self.pvalues = np.zeros(0, dtype=np.float64)
+        self.queries = 0
+        self.unique_tables = 0
+        self.cache_hits = 0
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                self.tables = cache['tables']
+                self.pvalues = cache['pvalues']
+
+    def fisher_exact(self, c00, c01, c10, c11):
+        """Same as fisher_exact(), testing only the tables missing from the cache"""
+        tables = np.stack([np.asarray(c, dtype=np.int64) for c in (c00, c01, c10, c11)], axis=1).reshape(-1, 4)
+
+        # Cached tables come first, so a single unique call matches the queried tables against the cache
+        known, inverse = np.unique(np.concatenate((self.tables, tables)), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        pvalues = np.full(len(known), np.nan)
+        pvalues[inverse[:len(self.tables)]] = self.pvalues
+
+        queried = np.unique(inverse[len(self.tables):])
+        missing = queried[np.isnan(pvalues[queried])]
+        pvalues[missing] = fisher_exact(*known[missing].T)
+
+        self.queries += len(tables)
+        self.unique_tables += len(queried)
+        self.cache_hits += len(queried) - len(missing)
+        self.tables, self.pvalues = known, pvalues
+
+        return pvalues[inverse[len(inverse) - len(tables):]]
+
+    def report(self):
+        """Returns a summary of the cache use"""
+        if self.queries == 0:
+            return "no tables tested"
+
+        deduplicated = 1 - self.unique_tables / self.queries
+        hit_rate = self.cache_hits / self.unique_tables
+
+        return f"{self.queries} tables, {self.unique_tables} distinct ({deduplicated:.2%} deduplicated), " \
+               f"{self.cache_hits} found in the cache (hit rate {hit_rate:.2%}), {self.unique_tables - self.cache_hits} tested"
+
+    def save(self):
+        if self.cache_file is None:
+            return
+
+        # The cache file is replaced only when completely written
+        with atomic_file(self.cache_file, '.tmp.npz') as tmp_file:
+            np.savez(tmp_file, tables=self.tables, pvalues=self.pvalues)
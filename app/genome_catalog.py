@@ -0,0 +1,108 @@
+import os
+import hashlib
+from app.io_utils import atomic_file
+
+# The catalog is a tab-separated, '.fai'-like file kept in the data directory with one line per chromosome:
+#   prefix, length, number of non-ACGT positions (N-count), number of soft-masked (lower-case) bases and the
+#   source FASTA file with its size, modification time and SHA-256 checksum
+CATALOG_FILE = 'genome_catalog.tsv'
+CATALOG_COLUMNS = ['prefix', 'length', 'n_count', 'soft_masked', 'source', 'source_size', 'source_mtime_ns', 'source_sha256']
+INTEGER_COLUMNS = ['length', 'n_count', 'soft_masked', 'source_size', 'source_mtime_ns']
+
+
+def file_checksum(file_path):
+    digest = hashlib.sha256()
+
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class GenomeCatalog:
+    """Chromosome lengths and composition recorded by the FASTA conversion, together with the state of the
+    source FASTA files used to detect stale conversions."""
+
+    def __init__(self, catalog_file_path, entries=None):
+        self.catalog_file_path = catalog_file_path
+        self.entries = {} if entries is None else entries
+
+    @classmethod
+    def load(cls, data_dir):
+        catalog_file_path = os.path.join(data_dir, CATALOG_FILE)
+        entries = {}
+
+        if os.path.exists(catalog_file_path):
+            with open(catalog_file_path, 'r') as file:
+                for line in file:
+                    if line.startswith('#'):
+                        continue
+
+                    entry = dict(zip(CATALOG_COLUMNS, line.rstrip('\n').split('\t')))
+                    for column in INTEGER_COLUMNS:
+                        entry[column] = int(entry[column])
+
+                    entries[entry['prefix']] = entry
+
+        return cls(catalog_file_path, entries)
+
+    def save(self):
+        with atomic_file(self.catalog_file_path) as tmp_file_path, open(tmp_file_path, 'w') as file:
+            file.write('#' + '\t'.join(CATALOG_COLUMNS) + '\n')
+
+            for prefix in self.entries.keys():
+                file.write('\t'.join(str(self.entries[prefix][column]) for column in CATALOG_COLUMNS) + '\n')
+
+    def update(self, prefix, source_file_path, composition, checksum=None):
+        """Records a converted chromosome. 'composition' is a dictionary with length, n_count and soft_masked."""
+        stat = os.stat(source_file_path)
+
+        self.entries[prefix] = {
+            'prefix': prefix,
+            'length': composition['length'],
+            'n_count': composition['n_count'],
+            'soft_masked': composition['soft_masked'],
+            'source': os.path.basename(source_file_path),
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+            'source_sha256': file_checksum(source_file_path) if checksum is None else checksum
+        }
+
+    def is_fresh(self, source_file_path):
+        """Checks if the recorded conversion of a FASTA file matches the file.
+
+        The size and modification time are compared first; if only the time differs (e.g. the file was
+        copied), the checksum decides and the entries are refreshed."""
+        entries = [self.entries[prefix] for prefix in self.records(source_file_path)]
+        if len(entries) == 0 or not os.path.exists(source_file_path):
+            return False
+
+        stat = os.stat(source_file_path)
+        if any(entry['source_size'] != stat.st_size for entry in entries):
+            return False
+
+        if all(entry['source_mtime_ns'] == stat.st_mtime_ns for entry in entries):
+            return True
+
+        checksum = file_checksum(source_file_path)
+        if any(entry['source_sha256'] != checksum for entry in entries):
+            return False
+
+        for entry in entries:
+            entry['source_mtime_ns'] = stat.st_mtime_ns
+
+        return True
+
+    def records(self, source_file_path):
+        """Returns prefixes of the chromosomes converted from a FASTA file, in the file order"""
+        source = os.path.basename(source_file_path)
+
+        return [prefix for prefix, entry in self.entries.items() if entry['source'] == source]
+
+    def remove_source(self, source_file_path):
+        for prefix in self.records(source_file_path):
+            del self.entries[prefix]
+
+    def length(self, prefix):
+        return self.entries[prefix]['length']
@@ -0,0 +1,65 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+# Outputs are written under a temporary name and get their final name only when complete, so an interrupted run
+# never leaves a truncated file or directory behind. Directory formats describe themselves in a 'meta.txt' file of
+# 'key=value' lines.
+META_FILE = 'meta.txt'
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def tmp_path(path, suffix='.tmp'):
+    """Returns the temporary path of an output, removing what an interrupted run left there"""
+    tmp = f'{path}{suffix}'
+    remove_path(tmp)
+
+    return tmp
+
+
+def replace_path(tmp, path):
+    """Gives a complete temporary file or directory its final name, replacing the previous output"""
+    if os.path.isdir(tmp):
+        remove_path(path)
+
+    os.replace(tmp, path)
+
+
+@contextmanager
+def atomic_file(path, suffix='.tmp'):
+    """Yields the temporary path of a file, which gets its final name when the block completes"""
+    tmp = tmp_path(path, suffix)
+    yield tmp
+    replace_path(tmp, path)
+
+
+@contextmanager
+def atomic_dir(path):
+    """Yields a new temporary directory, which replaces 'path' when the block completes"""
+    tmp = tmp_path(path)
+    os.makedirs(tmp)
+    yield tmp
+    replace_path(tmp, path)
+
+
+def write_meta(path, **values):
+    with open(os.path.join(path, META_FILE), 'w') as file:
+        for key, value in values.items():
+            file.write(f'{key}={value}\n')
+
+
+def read_meta(path):
+    """Returns the 'meta.txt' file of a directory as a dictionary of strings"""
+    meta = {}
+    with open(os.path.join(path, META_FILE), 'r') as file:
+        for line in file:
+            key, value = line.rstrip('\n').split('=', 1)
+            meta[key] = value
+
+    return meta
@@ -1,6 +1,10 @@
 import subprocess
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from app.text_formating import red, green, print_info, print_warning, print_logo
+from app.genome_catalog import GenomeCatalog
+from app.io_utils import tmp_path, replace_path
+from app.manifest import jellyfish_manifest
 
 
 def check(result):
@@ -19,80 +23,150 @@ def check(result):
     return True
 
 
-def kmer_counting(fasta_file, jellyfish_file, parameters):
-    print('')
-    print_info(f'Counting k-mers in the {fasta_file} file ... ')
+def run_streaming(command, header):
+    """Runs a command printing its stderr output as it arrives. Returns a tuple (return code, stderr lines)."""
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    stderr = []
 
-    result = subprocess.run(['jellyfish', 'count',
-                             '-m', parameters['kmer_length'],
-                             '-s', parameters['hash_size'],
-                             '-t', parameters['threads_number'],
-                             # '-C', fasta_file,
-                             fasta_file,
-                             '-o', jellyfish_file], capture_output=True, text=True)
+    for line in process.stderr:
+        line = line.rstrip()
+        if line != '':
+            stderr.append(line)
+            print_info(line, header)
 
-    if result.returncode:
+    return process.wait(), stderr
+
+
+def kmer_counting(fasta_file, jellyfish_file, parameters, threads_number, header=None):
+    print_info(f'Counting k-mers in the {os.path.basename(fasta_file)} file using {threads_number} threads ... ', header)
+
+    # '-C' counts a k-mer and its reverse complement together under the canonical k-mer
+    canonical = ['-C'] if parameters.get('canonical_kmers', 'no') == 'yes' else []
+    returncode, stderr = run_streaming(['jellyfish', 'count',
+                                        '-m', parameters['kmer_length'],
+                                        '-s', parameters['hash_size'],
+                                        '-t', str(threads_number)] + canonical +
+                                       [fasta_file,
+                                        '-o', jellyfish_file], header)
+
+    if returncode:
         print_warning('Something went wrong during k-mer counting.')
         print_warning('Please, check the stderr output:')
-        print(result.stderr)
-        print(parameters['kmer_length'], parameters['hash_size'], parameters['threads_number'], jellyfish_file)
+        print("\n".join(stderr))
+        print(parameters['kmer_length'], parameters['hash_size'], threads_number, jellyfish_file)
 
         return False
 
     return True
 
 
-def dump_jf_file(output_file_full_path, jellyfish_file_full_path, jellyfish_file, output_file_name):
-    print_info(f'Outputting counts from the {jellyfish_file} file to the {output_file_name} file ... ')
+def dump_jf_file(output_file_full_path, jellyfish_file_full_path, jellyfish_file, output_file_name, header=None):
+    print_info(f'Outputting counts from the {jellyfish_file} file to the {output_file_name} file ... ', header)
 
-    result = subprocess.run(['jellyfish', 'dump', jellyfish_file_full_path,
-                             '-o', output_file_full_path], capture_output=True, text=True)
+    # Column format with a tab separator: one 'k-mer<TAB>count' pair per line. The dump gets its final name
+    # only when complete, so an interrupted run never leaves a truncated dump behind.
+    tmp_file_full_path = tmp_path(output_file_full_path)
+    returncode, stderr = run_streaming(['jellyfish', 'dump', '-c', '-t', jellyfish_file_full_path,
+                                        '-o', tmp_file_full_path], header)
 
-    if result.returncode:
+    if returncode:
         print_warning('Something went wrong during outputting counts')
         print_warning('Please, check the stderr output:')
-        print(result.stderr)
+        print("\n".join(stderr))
 
         return False
 
+    replace_path(tmp_file_full_path, output_file_full_path)
+
     return True
 
 
-def remove_jf_file(jellyfish_file, parameters):
+def remove_jf_file(jellyfish_file, parameters, header=None):
     if parameters['keep_intermediate_jf_files'] == 'no':
-        print_info(f'Deleting the {jellyfish_file} file ... ')
+        print_info(f'Deleting the {jellyfish_file} file ... ', header)
 
         try:
             os.remove(jellyfish_file)
-            print_info(f"File '{jellyfish_file}' removed successfully")
+            print_info(f"File '{jellyfish_file}' removed successfully", header)
         except FileNotFoundError:
             print_warning(f'The {jellyfish_file} file was not found.')
 
 
+def dump_and_remove(job, parameters):
+    if not dump_jf_file(job['output_file_full_path'], job['jellyfish_file_full_path'], job['jellyfish_file'], job['output_file'], job['header']):
+        return False
+
+    remove_jf_file(job['jellyfish_file_full_path'], parameters, job['header'])
+    job['manifest'].record()
+
+    return True
+
+
+def count_and_dump(job, parameters, threads_number):
+    if not kmer_counting(job['fasta_file_full_path'], job['jellyfish_file_full_path'], parameters, threads_number, job['header']):
+        return False
+
+    return dump_and_remove(job, parameters)
+
+
 def jellyfish(parameters):
+    """Counts k-mers of all chromosomes using jellyfish.
+
+    Several chromosomes are counted at once and the 'threads_number' budget is split between them. Every job
+    dumps its counts in the same worker right after counting, so dumping one chromosome overlaps with counting
+    the others without running more jellyfish processes than the budget allows."""
     print_logo("K-mer counting using jellyfish")
     print_info('Start k-mer counting using jellyfish.')
 
+    catalog = GenomeCatalog.load(parameters['data_dir'])
+    jobs = []
     for file_prefix in parameters['prefixes']:
-        fasta_file = f'{file_prefix}.fasta'
-        fasta_file_full_path = os.path.join(parameters['data_dir'], fasta_file)
+        output_file = f'{file_prefix}_dump.tsv'
+        output_file_full_path = os.path.join(parameters['jellyfish_out_dir'], output_file)
+
+        manifest = jellyfish_manifest(parameters, file_prefix, catalog)
+        if manifest.is_done():
+            print_info(f'The output {output_file} file is up to date. Skipping ...')
+            continue
 
         jellyfish_file = f'{file_prefix}.jf'
-        jellyfish_file_full_path = os.path.join(parameters['jellyfish_out_dir'], jellyfish_file)
 
-        output_file = f'{file_prefix}_dump.fasta'
-        output_file_full_path = os.path.join(parameters['jellyfish_out_dir'], output_file)
+        # Chromosomes from compressed or multi-record FASTA files are stored next to the jellyfish outputs
+        fasta_file_full_path = os.path.join(parameters['jellyfish_fasta_dir'], f'{file_prefix}.fasta')
+        if not os.path.exists(fasta_file_full_path):
+            fasta_file_full_path = os.path.join(parameters['data_dir'], f'{file_prefix}.fasta')
 
-        if os.path.exists(output_file_full_path):
-            print_info(f'The output {output_file} file already exists. Skipping ...')
-            continue
+        jobs.append({
+            'fasta_file_full_path': fasta_file_full_path,
+            'jellyfish_file': jellyfish_file,
+            'jellyfish_file_full_path': os.path.join(parameters['jellyfish_out_dir'], jellyfish_file),
+            'output_file': output_file,
+            'output_file_full_path': output_file_full_path,
+            'header': f'{file_prefix} jellyfish',
+            'manifest': manifest
+        })
 
-        if not kmer_counting(fasta_file_full_path, jellyfish_file_full_path, parameters):
-            return False
+    if len(jobs) == 0:
+        return True
 
-        if not dump_jf_file(output_file_full_path, jellyfish_file_full_path, jellyfish_file, output_file):
-            return False
+    threads_number = int(parameters['threads_number'])
+    jobs_number = min(len(jobs), threads_number)
+    job_threads_number = max(threads_number // jobs_number, 1)
+    print_info(f'Running {jobs_number} jellyfish jobs at once, {job_threads_number} threads each.')
 
-        remove_jf_file(jellyfish_file_full_path, parameters)
+    output = True
 
-    return True
+    with ThreadPoolExecutor(jobs_number) as pool:
+        futures = [pool.submit(count_and_dump, job, parameters, job_threads_number) for job in jobs]
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            if not future.result():
+                output = False
+
+                for pending in futures:
+                    pending.cancel()
+
+    return output
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pandas as pd
+from app.kmer_codes import kmers_to_codes
+
+DUMP_CHUNK_SIZE = 5000000
+
+
+def read_dump_kmer_length(dump_file_path):
+    """Returns the length of k-mers stored in a column-format jellyfish dump (None for an empty dump)"""
+    with open(dump_file_path, 'r') as file:
+        line = file.readline()
+
+    if line == '':
+        return None
+
+    return len(line.split('\t')[0])
+
+
+def iter_dump_chunks(dump_file_path, kmer_length, chunk_size=DUMP_CHUNK_SIZE):
+    """Reads a column-format ('jellyfish dump -c -t') dump in chunks.
+
+    Yields tuples (codes, counts) of arrays holding at most 'chunk_size' k-mers."""
+    if os.path.getsize(dump_file_path) == 0:
+        return
+
+    chunks = pd.read_csv(dump_file_path, sep='\t', header=None, names=['kmer', 'count'],
+                         dtype={'kmer': str, 'count': np.int64}, chunksize=chunk_size)
+
+    for chunk in chunks:
+        yield kmers_to_codes(chunk['kmer'].to_numpy(), kmer_length), chunk['count'].to_numpy()
+
+
+def load_dump(dump_file_path, kmer_length, chunk_size=DUMP_CHUNK_SIZE):
+    """Loads a column-format jellyfish dump into arrays of k-mer codes and counts sorted by code"""
+    chunks = list(iter_dump_chunks(dump_file_path, kmer_length, chunk_size))
+
+    if len(chunks) == 0:
+        return kmers_to_codes([], kmer_length), np.zeros(0, dtype=np.int64)
+
+    codes = np.concatenate([codes for codes, _ in chunks])
+    counts = np.concatenate([counts for _, counts in chunks])
+    order = np.argsort(codes, kind='stable')
+
+    return codes[order], counts[order]
@@ -0,0 +1,105 @@
+import numpy as np
+
+BASES = b'ACGT'
+INVALID_BASE = 4
+
+ENCODING_TABLE = np.full(256, INVALID_BASE, dtype=np.uint8)
+for base_code, base in enumerate(BASES):
+    ENCODING_TABLE[base] = base_code
+
+DECODING_TABLE = np.frombuffer(BASES, dtype=np.uint8)
+COMPLEMENT_TABLE = str.maketrans('ACGT', 'TGCA')
+
+
+def code_dtype(kmer_length):
+    """Returns the smallest unsigned integer type able to hold a 2-bit encoded k-mer"""
+    if kmer_length <= 16:
+        return np.uint32
+    if kmer_length <= 32:
+        return np.uint64
+
+    raise ValueError(f'k-mers longer than 32 bp cannot be 2-bit encoded (k = {kmer_length})')
+
+
+def encode_sequence(sequence):
+    """Encodes a DNA sequence into an uint8 array (A=0, C=1, G=2, T=3, other characters=4).
+
+    Only upper-case A, C, G and T are valid bases, so windows containing soft-masked or ambiguous
+    positions never match a k-mer, exactly as a plain 'str.find' would."""
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii')
+
+    return ENCODING_TABLE[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def window_codes(encoded, kmer_length):
+    """Computes the integer code of every k-mer window of an encoded sequence.
+
+    Returns a tuple (codes, valid), where codes[i] is the code of the window starting at position i
+    and valid[i] is False if the window contains a non-ACGT character."""
+    dtype = code_dtype(kmer_length)
+    windows_number = len(encoded) - kmer_length + 1
+
+    if windows_number <= 0:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=bool)
+
+    codes = np.zeros(windows_number, dtype=dtype)
+    for offset in range(kmer_length):
+        codes <<= dtype(2)
+        codes |= encoded[offset:offset + windows_number] & 3
+
+    invalid = encoded >= INVALID_BASE
+    valid = ~invalid[:windows_number]
+    for offset in range(1, kmer_length):
+        valid &= ~invalid[offset:offset + windows_number]
+
+    return codes, valid
+
+
+def kmers_to_codes(kmers, kmer_length):
+    """Converts a sequence of k-mer strings into an array of integer codes"""
+    dtype = code_dtype(kmer_length)
+    encoded = ENCODING_TABLE[np.asarray(kmers, dtype=f'S{kmer_length}').view(np.uint8)].reshape(-1, kmer_length)
+
+    if np.any(encoded >= INVALID_BASE):
+        raise ValueError('k-mers can contain only A, C, G and T characters')
+
+    codes = np.zeros(len(encoded), dtype=dtype)
+    for offset in range(kmer_length):
+        codes <<= dtype(2)
+        codes |= encoded[:, offset]
+
+    return codes
+
+
+def codes_to_kmers(codes, kmer_length):
+    """Converts an array of integer codes back into a list of k-mer strings"""
+    shifts = np.arange(2 * (kmer_length - 1), -1, -2, dtype=np.uint64)
+    digits = (np.asarray(codes, dtype=np.uint64)[:, None] >> shifts) & np.uint64(3)
+    letters = DECODING_TABLE[digits.astype(np.uint8)]
+
+    return np.ascontiguousarray(letters).view(f'S{kmer_length}').ravel().astype(str).tolist()
+
+
+def reverse_complement_codes(codes, kmer_length):
+    """Returns codes of the reverse complements of k-mers (the complement of a 2-bit base is 3 - base)"""
+    dtype = code_dtype(kmer_length)
+    codes = np.asarray(codes, dtype=dtype)
+    reverse = np.zeros(len(codes), dtype=dtype)
+
+    for _ in range(kmer_length):
+        reverse <<= dtype(2)
+        reverse |= (codes & dtype(3)) ^ dtype(3)
+        codes = codes >> dtype(2)
+
+    return reverse
+
+
+def canonical_codes(codes, kmer_length):
+    """Returns canonical codes: the smaller code of a k-mer and its reverse complement. Codes follow the
+    lexicographic order of k-mers, so this is the canonical k-mer reported by 'jellyfish count -C'."""
+    return np.minimum(np.asarray(codes, dtype=code_dtype(kmer_length)), reverse_complement_codes(codes, kmer_length))
+
+
+def reverse_complement(kmer):
+    return kmer.upper().translate(COMPLEMENT_TABLE)[::-1]
@@ -1,22 +1,39 @@
 # Multitasking using Pool and map
 
 import os
-from intervaltree import Interval, IntervalTree
 import time
+import shutil
 from multiprocessing import Pool
-import copy
-from app.text_formating import red, green, print_info, print_logo
+from functools import lru_cache
+from app.text_formating import red, green, print_info, print_warning, print_logo
 import pandas as pd
+import numpy as np
+from app.kmer_codes import window_codes, codes_to_kmers, canonical_codes, reverse_complement
+from app.chromosome_cache import open_chromosome_cache, read_chromosome_length
+from app.annotation import AnnotationStore, AnnotationIndex
+from app.shared_arrays import SharedArrays, attach_arrays
+from app.jellyfish_dump import read_dump_kmer_length, load_dump
+from app.sparse_table import SparseTable
+from app.coords_index import write_coords_run, build_coords_index, CoordsIndex
+from app.genome_catalog import GenomeCatalog
+from app.manifest import kmer_counter_manifest
+from app.occurrence_index import OccurrenceIndex, index_path, occurrence_index_manifest, position_dtype, write_shard_run, \
+    build_occurrence_index
+from app.suffix_index import SuffixIndex, suffix_index_manifest
+from app.test_environment import kmer_lengths, kmer_parameters
+from app.io_utils import atomic_file, remove_path
+
+DEFAULT_SHARD_SIZE = 10000000
+# Shared annotation blocks attached by a worker process: {block name: (block, annotation index)}
+ATTACHED_ANNOTATIONS = {}
 
 
 class Timer:
-    def __init__(self, kmers_number, worker_name):
+    def __init__(self, worker_name):
         self.start = None
         self.stop = None
-        self.counter = 0
-        self.kmers_number = kmers_number
         self.worker_name = worker_name
-    
+
     def startt(self):
         self.start = time.time()
 
@@ -25,230 +42,449 @@ class Timer:
         diff = self.stop - self.start
         print_info(f"Processing kmers finished in {diff:.2f} sek", self.worker_name)
 
-    def print_progress(self):
-        self.counter += 1
-        offset = 100
-        diff = (self.counter / self.kmers_number) * 100
 
-        if not self.counter % offset or self.counter == self.kmers_number:
-            print_info(f'Processed {self.counter} / {self.kmers_number} ({diff:.2f}%) kmers ...', self.worker_name)
+def count_pairs(codes, columns, counts=None):
+    """Sums counts of identical (k-mer code, column) pairs. Returns the pairs sorted by code and column."""
+    if counts is None:
+        counts = np.ones(len(codes), dtype=np.int64)
 
+    if len(codes) == 0:
+        return codes, columns, counts
 
-class KmerCounter:
-    def __init__(self, parameters):
-        self.INTERVAL_FROM = 0
-        self.INTERVAL_TO = 1
-        self.INTERVAL_MITE_NAME = 2
+    order = np.lexsort((columns, codes))
+    codes, columns, counts = codes[order], columns[order], counts[order]
 
-        self.parameters = parameters
+    starts = np.flatnonzero(np.concatenate(([True], (codes[1:] != codes[:-1]) | (columns[1:] != columns[:-1]))))
 
-        if not os.path.exists(os.path.join(parameters['output_dir'], 'tables')):
-            os.mkdir(os.path.join(parameters['output_dir'], 'tables'))
+    return codes[starts], columns[starts], np.add.reduceat(counts, starts)
 
-        self.data_inputs = []
-        for prefix in parameters['prefixes']:
-            data_input = {
-                'dump_file': os.path.join(parameters['jellyfish_out_dir'], f'{prefix}_dump.fasta'),
-                'chr_file': os.path.join(parameters['data_dir'], f'{prefix}_oneLine.txt'),
-                'chr_name': prefix,
-                'output_file': os.path.join(parameters['output_dir'], 'tables', f'table_{prefix}')
-            }
-
-            self.data_inputs.append(data_input)
-
-
-    def my_find(self, str1, str2):
-        start = 0
-        end = len(str1)
-        all_finds = []
-        while str1.find(str2, start, end) != -1:
-            x = str1.find(str2, start, end)
-            all_finds.append(str(x))
-            start = x+1
-
-        return all_finds
-
-    def worker_controller(self, q):
-        while True:
-            input = q.get()
-            if input is None:
-                break
-            self.worker(input)
-            q.task_done()
-
-    def worker(self, data_input):
-        # print("Loading '{}' file ...".format(data_input["dump_file"]))
-        worker_name = f"{data_input['chr_name']} worker"
-        data_kmer = {}
-        name_tmp = ""
 
+def split_chromosome(chr_name, chr_file, kmer_lengths, shard_size, canonical=False):
+    """Splits a chromosome into shards of 'shard_size' window positions of the shortest k-mer length.
+
+    Shard sequences overlap by (k - 1) bases of the longest k-mer length, so every k-mer window of every length
+    belongs to exactly one shard."""
+    windows_number = max(read_chromosome_length(chr_file) - min(kmer_lengths) + 1, 0)
+
+    shards = []
+    for start in range(0, max(windows_number, 1), shard_size):
+        shards.append({
+            'chr_name': chr_name,
+            'chr_file': chr_file,
+            'kmer_lengths': list(kmer_lengths),
+            'canonical': canonical,
+            'start': start,
+            'end': min(start + shard_size, windows_number)
+        })
+
+    return shards
+
+
+def shard_windows(shard):
+    """Yields tuples (k-mer length, codes, positions) of the valid k-mer windows starting within a shard, for every
+    k-mer length of the shard. The shard sequence is read once and shared by all lengths. Codes of canonical
+    shards are the canonical codes of the windows, so both strands of a k-mer are counted under a single code."""
+    chromosome, _ = open_chromosome_cache(shard['chr_file'])
+    encoded = np.asarray(chromosome[shard['start']:shard['end'] + max(shard['kmer_lengths']) - 1])
+
+    for kmer_length in shard['kmer_lengths']:
+        windows_number = max(min(shard['end'], len(chromosome) - kmer_length + 1) - shard['start'], 0)
+        codes, valid = window_codes(encoded[:windows_number + kmer_length - 1], kmer_length)
+        positions = np.flatnonzero(valid)
+        codes = codes[positions]
+
+        if shard['canonical']:
+            codes = canonical_codes(codes, kmer_length)
+
+        yield kmer_length, codes, positions + shard['start']
+
+
+def classify_occurrences(annotation, codes, positions, kmer_length, coords_run):
+    """Saves coordinates of k-mer occurrences located inside MITEs as a run of 'coords_run' (a tuple (run directory,
+    shard start)). Returns sparse counts of k-mer occurrences as (k-mer code, column, count) triplets, codes and
+    positions of occurrences overlapping more than one MITE and the total numbers of occurrences of the k-mers
+    (codes and counts)"""
+    occurrences, columns, inside, inside_mites, multiple = annotation.classify(positions, kmer_length)
+    write_coords_run(*coords_run, codes[inside], annotation.begins[inside_mites], annotation.ends[inside_mites],
+                     annotation.families[inside_mites])
+    totals = np.unique(codes, return_counts=True)
+
+    return count_pairs(codes[occurrences], columns), (codes[multiple], positions[multiple]), (totals[0], totals[1].astype(np.int64))
+
+
+@lru_cache(maxsize=None)
+def load_occurrence_index(index_file):
+    return OccurrenceIndex.load(index_file)
+
+
+@lru_cache(maxsize=None)
+def load_annotation(annotation_dir, chr_name):
+    """Builds the annotation index of a chromosome from the cached annotation store once per worker process"""
+    return AnnotationStore.load(annotation_dir).index(chr_name)
+
+
+def share_annotation(store, chr_name):
+    """Copies the annotation index of a chromosome into a shared memory block. Returns a tuple (block, descriptor);
+    workers get only the descriptor and read the index with shared_annotation."""
+    block = SharedArrays(store.index(chr_name).arrays())
+
+    return block, dict(block.descriptor, family_names=store.family_names)
+
+
+def shared_annotation(descriptor):
+    """Returns the annotation index of a chromosome from its shared memory block, attached once per worker process"""
+    if descriptor['block'] not in ATTACHED_ANNOTATIONS:
+        block, arrays = attach_arrays(descriptor)
+        ATTACHED_ANNOTATIONS[descriptor['block']] = (block, AnnotationIndex.from_arrays(arrays, descriptor['family_names']))
+
+    return ATTACHED_ANNOTATIONS[descriptor['block']][1]
+
+
+def classify_shard(shard):
+    """Counts and classifies all k-mer windows starting within a shard.
+
+    Returns the shard together with a dictionary {k-mer length: results}, where the results are the sparse
+    counts, the occurrences overlapping more than one MITE and the k-mer totals (see classify_occurrences).
+    Coordinates of the occurrences inside MITEs are saved in the coords run directories of the shard."""
+    annotation = shared_annotation(shard['annotation'])
+
+    if 'index_file' in shard:
+        codes, positions = load_occurrence_index(shard['index_file']).occurrences(shard['start'], shard['end'])
+        coords_run = (shard['coords_runs'][shard['kmer_length']], shard['start'])
+
+        return shard, {shard['kmer_length']: classify_occurrences(annotation, codes, positions, shard['kmer_length'], coords_run)}
+
+    results = {}
+    for kmer_length, codes, positions in shard_windows(shard):
+        if kmer_length in shard['runs']:
+            run_dir, dtype = shard['runs'][kmer_length]
+            write_shard_run(run_dir, shard['start'], codes, positions, dtype)
+
+        results[kmer_length] = classify_occurrences(annotation, codes, positions, kmer_length,
+                                                    (shard['coords_runs'][kmer_length], shard['start']))
+
+    return shard, results
+
+
+def write_chromosome_tables(data_input, shard_results):
+    """Sums the shard counts of a chromosome and writes its table and coords files. 'data_input' is the reducer
+    task of the chromosome (see KmerCounter.reducer_task).
+
+    Total occurrences come from the scan classifying the occurrences. With the built-in backend the k-mers found
+    by the scan are the table rows, with jellyfish the rows are the k-mers of its dump: jellyfish also counts
+    soft-masked (lower-case) k-mers, which the scan skips as the baseline 'str.find' search did, so k-mers found
+    only in soft-masked regions get a zero total."""
+    worker_name = f"{data_input['label']} worker"
+    kmer_length = data_input['kmer_length']
+
+    annotation = shared_annotation(data_input['annotation'])
+
+    log_file_path = os.path.join(data_input['tables_dir'], time.strftime('%y-%m-%d_%H-%M_') + data_input["chr_name"] + "_log.txt")
+    log = open(log_file_path, 'a+')
+    log.write("Analysis started at " + time.ctime() + "\n")
+    log.flush()
+
+    timer = Timer(worker_name)
+    timer.startt()
+
+    shard_results = sorted(shard_results, key=lambda result: result[0]['start'])
+    codes, columns, counts = count_pairs(*[np.concatenate(arrays) for arrays in zip(*[result[1] for result in shard_results])])
+
+    scanned_codes = np.concatenate([result[3][0] for result in shard_results])
+    scanned_codes, _, scanned_totals = count_pairs(scanned_codes, np.zeros(len(scanned_codes), dtype=np.int64),
+                                                   np.concatenate([result[3][1] for result in shard_results]))
+
+    if data_input['counting_backend'] == 'builtin':
+        kmer_codes, kmer_totals = scanned_codes, scanned_totals
+        print_info(f"Counted {len(kmer_codes)} distinct {kmer_length}-mers in {data_input['chr_name']}", worker_name)
+    else:
         print_info(f"Start reading {os.path.basename(data_input['dump_file'])} file", worker_name)
+        kmer_codes, _ = load_dump(data_input['dump_file'], kmer_length)
+        print_info(f"Reading {os.path.basename(data_input['dump_file'])} file completed. Read {len(kmer_codes)} kmers.", worker_name)
 
-        with open(data_input["dump_file"], 'r') as file:
-            cont = True
-            while cont:
-                line = file.readline()
-                if line == '':
-                    cont = False
-                    break
-                line = line.rstrip()
-                if line[0] == ">":
-                    name_tmp = line[1:]
-                else:
-                    data_kmer[line] = name_tmp
-
-        print_info(f"Reading {os.path.basename(data_input['dump_file'])} file completed. Read {len(data_kmer)} kmers.", worker_name)
-
-        if len(list(data_kmer.keys())[0]) != int(self.parameters['kmer_length']):
-            print_info(f'{red("Warning")} - The kmer length in {os.path.basename(data_input["dump_file"])} ({len(list(data_kmer.keys())[0])} bp) file is not equal to '
-                  f'kmer length in config file ({self.parameters["kmer_length"]} bp)', worker_name)
-            return
-
-        print_info("Loading '{}' file ...".format( data_input["chr_file"] ), worker_name)
-        with open(data_input["chr_file"], 'r') as f:
-            chromosome = f.read()
-
-        #----------------------------------------#
-        print_info(f"Loading '{os.path.basename(self.parameters['bed_file'])}' file ...", worker_name)
-        data_mites = []
-        with open(self.parameters['bed_file'], 'r') as f:
-            while True:
-                line = f.readline()
-                if line == '':
-                    break
-                line = line.rstrip()
-                data_mites.append(line.split("\t"))
-        #----------------------------------------#
-
-        if os.path.exists( data_input["output_file"] ):
-            print_info("The file '{}' exists. Removing ...".format(data_input["output_file"]), worker_name)
-            os.remove(data_input["output_file"])
-
-        output = open(data_input["output_file"], 'a+')
-
-        output_data_template = {}
-        output_data_template["edge"] = 0
-        output_data_template["genome"] = 0
-        mite_names = []
-
-        t = IntervalTree()
-        for mite in data_mites:
-            if mite[3] not in output_data_template.keys():
-                output_data_template[mite[3]] = 0
-                output_data_template[mite[3] + "_edge"] = 0
-                mite_names.append(mite[3])
-                mite_names.append(mite[3] + "_edge")
-            if mite[0] == data_input["chr_name"]:
-                t[int(mite[1]) - 0:int(mite[2])] = mite[3]
-        mite_names = set(mite_names)
-
-        output.write("\t".join(["k-mer", "total_occurences_in_{}".format(data_input["chr_name"]), "\t".join(sorted(mite_names)), "edge", "genome"]))
-        output.write("\n")
-
-        timer = Timer(len(data_kmer), worker_name)
-        timer.startt()
-
-        print_info("Started analysis ...", worker_name)
-
-        log_file_path = os.path.join(self.parameters['output_dir'], 'tables', time.strftime('%y-%m-%d_%H-%M_') + data_input["chr_name"] + "_log.txt")
-        # log = open(time.strftime('%y-%m-%d_%H-%M_') + data_input["chr_name"] + "_log.txt", 'a+')
-        log = open(log_file_path, 'a+')
-        log.write("Analysis started at " + time.ctime() + "\n")
-        log.flush()
-
-        kmer_No = 0
-        kmer_coords = {}
-
-        for kmer in data_kmer.keys():
-            timer.print_progress()
-
-            kmer_coords[kmer] = []
-
-            output_data = copy.deepcopy(output_data_template)
-
-            kmer_occurences = self.my_find(chromosome, kmer)
-
-            for kmer_occurence in kmer_occurences:
-                kmer_occurence = int(kmer_occurence)
-                # result = t[kmer_occurence + 1:kmer_occurence + 11]
-                # result = t[kmer_occurence + 1:kmer_occurence + int(self.parameters['kmer_length']) + 1]
-                result = t[kmer_occurence:kmer_occurence + int(self.parameters['kmer_length']) + 1]
-                if result:
-                    if len( list(result) ) > 2:
-                        print_info(f"\nThe interval tree length is higher than 2: {len( list(result) )} {data_input['chr_name']}", worker_name)
-                        log.write("\t".join(["intTree>2", kmer, str(kmer_occurence), mite_name]) + "\n")
-                        log.flush()
-                        log.close()
-                        exit(1)
-                    elif len( list(result) ) > 1:  # True if a k-mer overlaps two mites
-                        print_info(f"\nThe interval tree length is higher than 1: {data_input['chr_name']}", worker_name)
-                        log.write("\t".join(["1<intTree<2", kmer, str(kmer_occurence), str(list(result))]) + "\n")
-                        log.flush()
-
-                        for interval in result:
-                            output_data["edge"] += 1
-                            output_data[interval.data + "_edge"] += 1
-                    else:
-                        result_parsed = list(result)[0]
-                        result_parsed_list = list(result_parsed)
-
-                        if (kmer_occurence) >= (result_parsed.begin - 1) and \
-                            (kmer_occurence + int(self.parameters['kmer_length'])) <= result_parsed.end:
-                            output_data[result_parsed.data] += 1
-                            kmer_coords[kmer].append("\t".join([data_input["chr_name"], str(result_parsed_list[self.INTERVAL_FROM]), str(result_parsed_list[self.INTERVAL_TO]), f"{kmer};{result_parsed_list[self.INTERVAL_MITE_NAME]}"]))
-                            # kmer_coords[kmer].append(data_input["chr_name"] + ":" + "-".join(
-                            #     [str(result_parsed_list[0]), str(result_parsed_list[1])]))
-                        else:
-                            output_data["edge"] += 1
-                            output_data[result_parsed.data + "_edge"] += 1
-                else:
-                    output_data["genome"] += 1
-
-            kmer_No += 1
-
-            output.write("\t".join([kmer, str(len(kmer_occurences))]))
-            for mite_name in sorted(mite_names):
-                output.write("\t" + str(output_data[mite_name]))
-            output.write("\t" + str(output_data["edge"]))
-            output.write("\t" + str(output_data["genome"]))
-            output.write("\n")
-        log.close()
-        output.close()
-        timer.stopp()
-
-        self.write_kmer_coords_to_file(data_input['chr_name'], kmer_coords)
-
-    def write_kmer_coords_to_file(self, prefix, kmer_coords):
-        with open(os.path.join(self.parameters['output_dir'], 'tables', f"table_{prefix}_coords.txt"), 'w') as file:
-            for key in kmer_coords.keys():
-                if len(kmer_coords[key]) > 0:
-                    # file.write(key + "\n")
-                    file.write("\n".join(kmer_coords[key]) + "\n")
+        # Only k-mers of the dump get a row in the table (k-mers never found by the scan keep a zero total)
+        kmer_totals = np.zeros(len(kmer_codes), dtype=np.int64)
+        found = np.isin(scanned_codes, kmer_codes)
+        kmer_totals[np.searchsorted(kmer_codes, scanned_codes[found])] = scanned_totals[found]
+
+    keep = np.isin(codes, kmer_codes)
+    table = SparseTable.from_triplets(kmer_length, annotation.column_names, kmer_codes, kmer_totals,
+                                      np.searchsorted(kmer_codes, codes[keep]), columns[keep], counts[keep],
+                                      total_column=f"total_occurences_in_{data_input['chr_name']}")
+    table.save(data_input["output_file"])
+
+    multiple_codes, multiple_positions = [np.concatenate(arrays) for arrays in zip(*[result[2] for result in shard_results])]
+    if len(multiple_codes):
+        print_info(f"{len(multiple_codes)} k-mer occurrences overlap more than one MITE: {data_input['chr_name']}", worker_name)
+        for kmer, position in zip(codes_to_kmers(multiple_codes, kmer_length), multiple_positions.tolist()):
+            mites = annotation.mites_at(position, kmer_length)
+            log.write("\t".join(["1<intTree<2" if len(mites) == 2 else "intTree>2", kmer, str(position),
+                                 str([(int(annotation.begins[mite]), int(annotation.ends[mite]), annotation.family_names[annotation.families[mite]]) for mite in mites])]) + "\n")
+
+    log.close()
+    timer.stopp()
+
+    write_kmer_coords(data_input, annotation, kmer_codes)
+
+    if data_input['export_tsv_tables'] == 'yes':
+        export_tsv_tables(data_input, table)
+    else:
+        # Text tables of a previous run would not match the new binary ones
+        for path in (data_input['tsv_file'], data_input['coords_tsv_file']):
+            remove_path(path)
+
+    if data_input['build_index']:
+        print_info(f"Building the occurrence index of {data_input['label']} ...", worker_name)
+        build_occurrence_index(data_input['run_dir'], data_input['index_file'], data_input['chr_name'],
+                               kmer_length, data_input['position_dtype'])
+
+
+def write_kmer_coords(data_input, annotation, kmer_codes):
+    build_coords_index(data_input['coords_run_dir'], data_input['coords_file'], data_input['kmer_length'], data_input['chr_name'],
+                       annotation.family_names, kmer_codes)
 
-    def check_run(self):
-        for prefix in self.parameters['prefixes']:
-            if not os.path.exists(os.path.join(self.parameters['output_dir'], 'tables', f'table_{prefix}')):
-                return True
 
-        if self.parameters['keep_kmers_table'] == 'yes':
-            print_info("Keeping k-mer counting from the previous run")
+def export_tsv_tables(data_input, table=None):
+    """Exports the table and k-mer coordinates of a chromosome in the tab-separated text format. The table is
+    loaded from its binary file unless given."""
+    table = SparseTable.load(data_input['output_file']) if table is None else table
+
+    with atomic_file(data_input['tsv_file']) as tmp_file:
+        table.export_tsv(tmp_file)
+
+    with atomic_file(data_input['coords_tsv_file']) as tmp_file, open(tmp_file, 'w') as file:
+        CoordsIndex.load(data_input['coords_file']).write_tsv(file)
+
+
+class KmerCounter:
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.kmer_lengths = kmer_lengths(parameters)
+        self.canonical = parameters.get('canonical_kmers', 'no') == 'yes'
+        self.shard_size = int(parameters.get('shard_size', DEFAULT_SHARD_SIZE))
+
+        self.data_inputs = []
+        for kmer_length in self.kmer_lengths:
+            k_parameters = kmer_parameters(parameters, kmer_length)
+            tables_dir = os.path.join(k_parameters['output_dir'], 'tables')
+
+            if not os.path.exists(tables_dir):
+                os.mkdir(tables_dir)
+
+            for prefix in parameters['prefixes']:
+                data_input = {
+                    'dump_file': os.path.join(k_parameters['jellyfish_out_dir'], f'{prefix}_dump.tsv'),
+                    'chr_file': os.path.join(parameters['data_dir'], f'{prefix}_chrom.bin'),
+                    'chr_name': prefix,
+                    'kmer_length': kmer_length,
+                    'parameters': k_parameters,
+                    'label': prefix if len(self.kmer_lengths) == 1 else f'{prefix}, k={kmer_length}',
+                    'tables_dir': tables_dir,
+                    'output_file': os.path.join(tables_dir, f'table_{prefix}.sparse'),
+                    'tsv_file': os.path.join(tables_dir, f'table_{prefix}'),
+                    'coords_file': os.path.join(tables_dir, f'table_{prefix}.coords'),
+                    'coords_tsv_file': os.path.join(tables_dir, f'table_{prefix}_coords.txt')
+                }
+
+                self.data_inputs.append(data_input)
+
+    def get_shards(self, data_inputs):
+        """Splits the pending chromosomes into shards. Returns a list of (data inputs, shards) groups.
+
+        All k-mer lengths of a chromosome are counted in a single scan, so they form one group of window shards.
+        A chromosome and k-mer length with an up-to-date occurrence index forms a group of its own, split into
+        shards of the index occurrences."""
+        groups = []
+
+        # Shards save coordinates of the occurrences inside MITEs sorted by k-mer, the reducer joins them
+        for data_input in data_inputs:
+            data_input['coords_run_dir'] = f"{data_input['coords_file']}.runs"
+            if os.path.exists(data_input['coords_run_dir']):
+                shutil.rmtree(data_input['coords_run_dir'])
+            os.makedirs(data_input['coords_run_dir'])
+
+        for chr_name in dict.fromkeys(data_input['chr_name'] for data_input in data_inputs):
+            scanned = []
+
+            for data_input in [data_input for data_input in data_inputs if data_input['chr_name'] == chr_name]:
+                if not data_input['use_index']:
+                    scanned.append(data_input)
+                    continue
+
+                print_info(f"Classifying k-mer occurrences of {data_input['label']} from the occurrence index")
+                occurrences_number = len(OccurrenceIndex.load(data_input['index_file']))
+
+                groups.append(([data_input], [{'chr_name': chr_name, 'index_file': data_input['index_file'],
+                                               'kmer_length': data_input['kmer_length'],
+                                               'coords_runs': {data_input['kmer_length']: data_input['coords_run_dir']}, 'start': start,
+                                               'end': min(start + self.shard_size, occurrences_number)}
+                                              for start in range(0, max(occurrences_number, 1), self.shard_size)]))
+
+            if len(scanned) == 0:
+                continue
+
+            shards = split_chromosome(chr_name, scanned[0]['chr_file'], [data_input['kmer_length'] for data_input in scanned],
+                                      self.shard_size, self.canonical)
+            for shard in shards:
+                shard['runs'] = {}
+                shard['coords_runs'] = {data_input['kmer_length']: data_input['coords_run_dir'] for data_input in scanned}
+
+            for data_input in scanned:
+                if not data_input['build_index']:
+                    continue
+
+                # Shards save their occurrences sorted by k-mer, the reducer joins them into the index
+                run_dir = f"{data_input['index_file']}.runs"
+                if os.path.exists(run_dir):
+                    shutil.rmtree(run_dir)
+                os.makedirs(run_dir)
+
+                data_input['run_dir'] = run_dir
+                data_input['position_dtype'] = position_dtype(read_chromosome_length(data_input['chr_file']))
+                for shard in shards:
+                    shard['runs'][data_input['kmer_length']] = (run_dir, data_input['position_dtype'])
+
+            groups.append((scanned, shards))
+
+        return groups
+
+    def check_kmer_length(self, data_input):
+        dump_kmer_length = read_dump_kmer_length(data_input['dump_file'])
+
+        if dump_kmer_length is not None and dump_kmer_length != data_input['kmer_length']:
+            print_info(f'{red("Warning")} - The kmer length in {os.path.basename(data_input["dump_file"])} ({dump_kmer_length} bp) file is not equal to '
+                       f'kmer length in config file ({data_input["kmer_length"]} bp). Skipping ...', f"{data_input['label']} worker")
             return False
 
         return True
 
+    def check_run(self):
+        """Returns data inputs of chromosomes (and k-mer lengths) which need counting. Results of a chromosome are
+        kept if its manifest matches the current inputs, so an interrupted run resumes with the remaining chromosomes."""
+        catalog = GenomeCatalog.load(self.parameters['data_dir'])
+        pending = []
+
+        for data_input in self.data_inputs:
+            k_parameters = data_input['parameters']
+            data_input['manifest'] = kmer_counter_manifest(k_parameters, data_input['chr_name'], catalog)
+
+            if self.parameters['keep_kmers_table'] == 'yes' and data_input['manifest'].is_done():
+                print_info(f"Keeping k-mer counting of {data_input['label']} from the previous run")
+
+                # Text tables are not a part of the manifest, they are exported from the kept binary tables
+                if self.parameters.get('export_tsv_tables', 'no') == 'yes' and \
+                        not all(os.path.exists(data_input[key]) for key in ('tsv_file', 'coords_tsv_file')):
+                    print_info(f"Exporting tables of {data_input['label']} to the text format ...")
+                    export_tsv_tables(data_input)
+                continue
+
+            data_input['index_file'] = index_path(k_parameters, data_input['chr_name'])
+            data_input['index_manifest'] = occurrence_index_manifest(k_parameters, data_input['chr_name'], catalog)
+            data_input['use_index'] = data_input['index_manifest'].is_done()
+            data_input['build_index'] = not data_input['use_index'] and self.parameters.get('occurrence_index', 'no') == 'yes'
+
+            pending.append(data_input)
+
+        return pending
+
+    def count_kmers(self, kmers):
+        """Counts k-mers of any length (e.g. extensions of a significant k-mer) in all chromosomes using their
+        suffix indexes, without a new counting run. Returns a DataFrame laid out as the merged table. In the
+        canonical mode occurrences of the reverse complements are counted too. k-mers are reported in upper case."""
+        catalog = GenomeCatalog.load(self.parameters['data_dir'])
+        _, annotation_dir = AnnotationStore.open(self.parameters['bed_file'], self.parameters['cache_dir'])
+
+        table = None
+        for prefix in self.parameters['prefixes']:
+            if not suffix_index_manifest(self.parameters, prefix, catalog).is_done():
+                raise ValueError(f"There is no up-to-date suffix index of {prefix} (see the 'suffix_index' parameter)")
+
+            index = SuffixIndex.load(self.parameters, prefix)
+            annotation = load_annotation(annotation_dir, prefix)
+            if table is None:
+                table = pd.DataFrame(0, index=list(dict.fromkeys(kmer.upper() for kmer in kmers)),
+                                     columns=["total_occurences"] + annotation.column_names, dtype=np.int64)
+
+            for kmer in table.index:
+                positions = index.locate(kmer)
+                if self.canonical and reverse_complement(kmer) != kmer:
+                    positions = np.sort(np.concatenate((positions, index.locate(reverse_complement(kmer)))))
+                _, columns, _, _, _ = annotation.classify(positions, len(kmer))
+
+                table.loc[kmer, "total_occurences"] += len(positions)
+                table.loc[kmer, annotation.column_names] += np.bincount(columns, minlength=len(annotation.column_names))
+
+        return table
+
+    def reducer_task(self, data_input, annotation):
+        """Returns the data input of a chromosome as a small reducer task: paths and flags only, without the
+        parameters and manifests, plus the descriptor of the shared annotation"""
+        task = {key: value for key, value in data_input.items() if key not in ('parameters', 'manifest', 'index_manifest')}
+        task['annotation'] = annotation
+        task['export_tsv_tables'] = self.parameters.get('export_tsv_tables', 'no')
+        task['counting_backend'] = self.parameters['counting_backend']
+
+        return task
+
     def run(self):
+        """Runs the k-mer counting stage. With the jellyfish backend the table rows are read from jellyfish
+        dumps, the built-in backend takes them from the classifying scan itself."""
         print_logo("K-mer counting")
 
-        if not self.check_run():
+        self.data_inputs = self.check_run()
+        if len(self.data_inputs) == 0:
             return True
 
+        blocks = {}
+        annotations = {}
         try:
+            if self.parameters['counting_backend'] == 'jellyfish':
+                self.data_inputs = [data_input for data_input in self.data_inputs if self.check_kmer_length(data_input)]
+
+            print_info(f"Loading '{os.path.basename(self.parameters['bed_file'])}' file ...")
+            store, _ = AnnotationStore.open(self.parameters['bed_file'], self.parameters['cache_dir'])
+
+            # Annotation indexes are built once and shared by all workers; tasks carry only their descriptors
+            for chr_name in dict.fromkeys(data_input['chr_name'] for data_input in self.data_inputs):
+                blocks[chr_name], annotations[chr_name] = share_annotation(store, chr_name)
+
+            groups = self.get_shards(self.data_inputs)
+            group_results = [[] for _ in groups]
+            print_info(f"Counting k-mers in {sum(len(shards) for _, shards in groups)} shards of {len(blocks)} chromosomes ...")
+
             with Pool(int(self.parameters['threads_number'])) as pool:
-                pool.map(self.worker, self.data_inputs)
+                reducers = []
+                tasks = [dict(shard, group=group, annotation=annotations[shard['chr_name']])
+                         for group, (_, shards) in enumerate(groups) for shard in shards]
+
+                for shard, results in pool.imap_unordered(classify_shard, tasks):
+                    group_results[shard['group']].append((shard, results))
+
+                    # Chromosome tables are written as soon as all shards of their group are counted
+                    data_inputs, shards = groups[shard['group']]
+                    if len(group_results[shard['group']]) == len(shards):
+                        for data_input in data_inputs:
+                            kmer_length = data_input['kmer_length']
+                            shard_results = [(shard, *results[kmer_length]) for shard, results in group_results[shard['group']]]
+
+                            reducers.append((data_input, pool.apply_async(write_chromosome_tables, (
+                                self.reducer_task(data_input, annotations[data_input['chr_name']]), shard_results))))
+
+                        group_results[shard['group']] = None
+
+                for data_input, reducer in reducers:
+                    reducer.get()
+                    data_input['manifest'].record()
+
+                    if data_input['build_index']:
+                        data_input['index_manifest'].record()
 
             return True
-        except Exception:
-            return False
+        except Exception as e:
+            print_warning('Something went wrong during k-mer counting.')
+            print(e)
 
-        # p = Pool(self.parameters['threads_number'])
-        # p.map(self.worker, self.data_inputs)
+            return False
+        finally:
+            for block in blocks.values():
+                block.unlink()
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import hashlib
+from functools import lru_cache
+from app.io_utils import atomic_file
+from app.genome_catalog import GenomeCatalog, file_checksum
+
+# Every finished stage (or a single chromosome of a stage) leaves a JSON manifest in this directory of the
+# output directory. A manifest holds the key of the stage: a hash of its inputs, i.e. checksums of input files,
+# keys of the stages it depends on and the configuration parameters that affect its results.
+MANIFEST_DIR = 'manifests'
+
+
+@lru_cache(maxsize=None)
+def cached_checksum(file_path, size, mtime_ns):
+    return file_checksum(file_path)
+
+
+def file_fingerprint(file_path):
+    """Returns the SHA-256 of a file, computed once per file version within a run"""
+    stat = os.stat(file_path)
+
+    return cached_checksum(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def stage_key(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class StageManifest:
+    def __init__(self, parameters, name, inputs, outputs):
+        self.path = os.path.join(parameters['output_dir'], MANIFEST_DIR, f'{name}.json')
+        self.name = name
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.key = stage_key(inputs)
+
+    def is_done(self):
+        """Checks if the stage finished with the same inputs and its outputs still exist"""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r') as file:
+            try:
+                manifest = json.load(file)
+            except ValueError:
+                return False
+
+        return manifest.get('key') == self.key and all(os.path.exists(output) for output in self.outputs)
+
+    def record(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with atomic_file(self.path) as tmp_path, open(tmp_path, 'w') as file:
+            json.dump({'stage': self.name, 'key': self.key, 'inputs': self.inputs, 'outputs': self.outputs,
+                       'finished': time.ctime()}, file, indent=2, sort_keys=True)
+
+    def invalidate(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def chromosome_fingerprint(catalog, prefix):
+    entry = catalog.entries[prefix]
+
+    return {'name': prefix, 'source': entry['source'], 'source_sha256': entry['source_sha256']}
+
+
+def jellyfish_manifest(parameters, prefix, catalog=None):
+    catalog = GenomeCatalog.load(parameters['data_dir']) if catalog is None else catalog
+    inputs = {'chromosome': chromosome_fingerprint(catalog, prefix), 'kmer_length': parameters['kmer_length'],
+              'canonical_kmers': parameters.get('canonical_kmers', 'no')}
+
+    return StageManifest(parameters, f'jellyfish_{prefix}', inputs,
+                         [os.path.join(parameters['jellyfish_out_dir'], f'{prefix}_dump.tsv')])
+
+
+def kmer_counter_manifest(parameters, prefix, catalog=None):
+    catalog = GenomeCatalog.load(parameters['data_dir']) if catalog is None else catalog
+    inputs = {
+        'chromosome': chromosome_fingerprint(catalog, prefix),
+        'bed_file': file_fingerprint(parameters['bed_file']),
+        'kmer_length': parameters['kmer_length'],
+        'counting_backend': parameters['counting_backend'],
+        'canonical_kmers': parameters.get('canonical_kmers', 'no')
+    }
+    tables_dir = os.path.join(parameters['output_dir'], 'tables')
+    outputs = [os.path.join(tables_dir, f'table_{prefix}.sparse'), os.path.join(tables_dir, f'table_{prefix}.coords')]
+
+    return StageManifest(parameters, f'kmer_counter_{prefix}', inputs, outputs)
+
+
+def table_merger_manifest(parameters):
+    catalog = GenomeCatalog.load(parameters['data_dir'])
+    inputs = {
+        'tables': [kmer_counter_manifest(parameters, prefix, catalog).key for prefix in parameters['prefixes']]
+    }
+
+    return StageManifest(parameters, 'table_merger', inputs,
+                         [os.path.join(parameters['output_dir'], 'tables', 'table_merged.sparse')])
+
+
+def stats_manifest(parameters):
+    # Thresholds are not a part of the key: filtering is always repeated on the saved test results
+    inputs = {'merged_table': table_merger_manifest(parameters).key}
+
+    return StageManifest(parameters, 'stats', inputs, [os.path.join(parameters['output_dir'], 'stats', 'stats.txt')])
+
+
+def tomtom_manifest(parameters, kmers_file_path, shards_dir):
+    # The number of threads only sets how queries are split into shards; kept results are merged whatever their number
+    inputs = {
+        'kmers': file_fingerprint(kmers_file_path),
+        'motif_database': file_fingerprint(parameters['motif_database']),
+        'min_overlap': parameters['min_overlap'],
+        'internal': parameters['internal']
+    }
+
+    return StageManifest(parameters, 'tomtom', inputs, [shards_dir])
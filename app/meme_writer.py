@@ -0,0 +1,63 @@
+from app.io_utils import atomic_file
+
+# DNA letters matched by IUPAC codes
+IUPAC_CODES = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'
+}
+ALPHABET = 'ACGT'
+# Number of sites assumed by iupac2meme when it builds a matrix from a single sequence
+DEFAULT_NSITES = 20
+
+
+def meme_header(background=None):
+    """Returns the MEME file header of a DNA motif set (uniform background unless given)"""
+    if background is None:
+        background = {letter: 0.25 for letter in ALPHABET}
+
+    frequencies = " ".join(f"{letter} {background[letter]:.3f}" for letter in ALPHABET)
+
+    return "MEME version 4\n\n" \
+           f"ALPHABET= {ALPHABET}\n\n" \
+           "strands: + -\n\n" \
+           "Background letter frequencies\n" \
+           f"{frequencies} \n\n"
+
+
+def letter_probabilities(iupac):
+    """Returns the letter-probability matrix of an IUPAC sequence: a list of rows of A, C, G, T probabilities"""
+    matrix = []
+
+    for code in iupac.upper():
+        if code not in IUPAC_CODES:
+            raise ValueError(f"'{code}' is not an IUPAC DNA code (motif {iupac})")
+
+        letters = IUPAC_CODES[code]
+        matrix.append([1 / len(letters) if letter in letters else 0.0 for letter in ALPHABET])
+
+    return matrix
+
+
+def meme_motif(iupac, nsites=DEFAULT_NSITES):
+    """Returns a single motif in the MEME format, as written by iupac2meme"""
+    rows = "".join("".join(f"  {probability:.6f}\t" for probability in row) + "\n" for row in letter_probabilities(iupac))
+
+    return f"MOTIF {iupac} \n\n" \
+           f"letter-probability matrix: alength= {len(ALPHABET)} w= {len(iupac)} nsites= {nsites} E= 0\n" \
+           f"{rows}\n"
+
+
+def write_meme(motifs, meme_file_path):
+    """Writes IUPAC sequences as a single MEME motif file (one header, one matrix per sequence).
+    Returns the number of written motifs."""
+    motifs_number = 0
+
+    with atomic_file(meme_file_path) as tmp_file_path, open(tmp_file_path, 'w') as file:
+        file.write(meme_header())
+
+        for iupac in motifs:
+            file.write(meme_motif(iupac))
+            motifs_number += 1
+
+    return motifs_number
@@ -0,0 +1,152 @@
+import os
+import glob
+import shutil
+import numpy as np
+from app.kmer_codes import code_dtype
+from app.io_utils import atomic_dir, write_meta, read_meta
+from app.manifest import StageManifest, chromosome_fingerprint
+
+# An occurrence index holds positions of all k-mer windows of a chromosome in the CSR layout:
+#   codes.bin     - uint64 distinct k-mer codes, sorted
+#   offsets.bin   - int64 offsets: positions of the i-th k-mer are stored between offsets[i] and offsets[i + 1]
+#   positions.bin - window start positions, sorted within every k-mer (uint32, or int64 for chromosomes longer
+#                   than 4 Gbp)
+#   meta.txt      - 'key=value' lines: kmer_length, chr_name, kmers, occurrences and position_dtype
+# The index is built from sorted runs written by the counting shards and is used to classify occurrences against
+# a new annotation without scanning the chromosome again.
+INDEX_DIR = 'index'
+
+
+def index_path(parameters, prefix):
+    return os.path.join(parameters['output_dir'], INDEX_DIR, f"{prefix}_k{parameters['kmer_length']}.occ")
+
+
+def occurrence_index_manifest(parameters, prefix, catalog):
+    inputs = {'chromosome': chromosome_fingerprint(catalog, prefix), 'kmer_length': parameters['kmer_length'],
+              'canonical_kmers': parameters.get('canonical_kmers', 'no')}
+
+    return StageManifest(parameters, f"occurrence_index_{prefix}_k{parameters['kmer_length']}", inputs,
+                         [index_path(parameters, prefix)])
+
+
+def position_dtype(chromosome_length):
+    return np.dtype('<u4') if chromosome_length < 2 ** 32 else np.dtype('<i8')
+
+
+def write_shard_run(run_dir, shard_start, codes, values, dtype):
+    """Saves values of k-mer occurrences of a shard (e.g. positions) sorted by k-mer code. Values of a k-mer keep
+    their order, so positions stay ascending within a code."""
+    order = np.argsort(codes, kind='stable')
+
+    np.save(os.path.join(run_dir, f'{shard_start:015d}_codes.npy'), codes[order].astype('<u8'))
+    np.save(os.path.join(run_dir, f'{shard_start:015d}_values.npy'), np.asarray(values)[order].astype(dtype))
+
+
+def join_shard_runs(run_dir, values_path, dtype, kept_codes=None):
+    """Joins sorted shard runs into a single file of values grouped by k-mer code. Returns a tuple (codes, offsets):
+    values of the i-th k-mer are stored between offsets[i] and offsets[i + 1]. With 'kept_codes' only values of
+    these k-mers are kept.
+
+    Runs are read one at a time: the first pass counts values of every k-mer, the second one scatters values of
+    each run right behind the values of the preceding runs, so values of a k-mer keep the order of the shards."""
+    runs = [(file_path, file_path.replace('_codes.npy', '_values.npy'))
+            for file_path in sorted(glob.glob(os.path.join(run_dir, '*_codes.npy')))]
+
+    run_codes = []
+    run_counts = []
+    for codes_path, _ in runs:
+        codes, counts = np.unique(np.load(codes_path, mmap_mode='r'), return_counts=True)
+        run_codes.append(codes)
+        run_counts.append(counts)
+
+    all_codes = np.concatenate(run_codes) if runs else np.zeros(0, dtype=np.uint64)
+    all_counts = np.concatenate(run_counts) if runs else np.zeros(0, dtype=np.int64)
+    codes = np.unique(all_codes)
+    if kept_codes is not None:
+        codes = codes[np.isin(codes, kept_codes)]
+    totals = np.zeros(len(codes), dtype=np.int64)
+    kept = np.isin(all_codes, codes)
+    np.add.at(totals, np.searchsorted(codes, all_codes[kept]), all_counts[kept])
+
+    offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(totals, out=offsets[1:])
+
+    if offsets[-1] == 0:
+        open(values_path, 'wb').close()
+        return codes, offsets
+
+    value_shape = np.load(runs[0][1], mmap_mode='r').shape[1:]
+    values = np.memmap(values_path, dtype=dtype, mode='w+', shape=(int(offsets[-1]),) + value_shape)
+    cursor = offsets[:-1].copy()
+
+    for (_, run_path), unique_codes, counts in zip(runs, run_codes, run_counts):
+        kept = np.isin(unique_codes, codes)
+        run_values = np.load(run_path)[np.repeat(kept, counts)]
+        unique_codes, counts = unique_codes[kept], counts[kept]
+
+        rows = np.searchsorted(codes, unique_codes)
+        ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        values[np.repeat(cursor[rows], counts) + ranks] = run_values
+        cursor[rows] += counts
+
+    values.flush()
+    del values
+
+    return codes, offsets
+
+
+def build_occurrence_index(run_dir, path, chr_name, kmer_length, dtype):
+    """Joins sorted shard runs of positions into an occurrence index"""
+    with atomic_dir(path) as tmp_path:
+        codes, offsets = join_shard_runs(run_dir, os.path.join(tmp_path, 'positions.bin'), dtype)
+        codes.astype('<u8').tofile(os.path.join(tmp_path, 'codes.bin'))
+        offsets.astype('<i8').tofile(os.path.join(tmp_path, 'offsets.bin'))
+
+        write_meta(tmp_path, kmer_length=kmer_length, chr_name=chr_name, kmers=len(codes), occurrences=offsets[-1],
+                   position_dtype=dtype.str)
+
+    shutil.rmtree(run_dir)
+
+
+class OccurrenceIndex:
+    def __init__(self, kmer_length, chr_name, codes, offsets, positions):
+        self.kmer_length = kmer_length
+        self.chr_name = chr_name
+        self.codes = codes
+        self.offsets = offsets
+        self.positions = positions
+
+    @classmethod
+    def load(cls, path):
+        """Opens a saved index. Arrays are memory-mapped."""
+        meta = read_meta(path)
+
+        kmers, occurrences = int(meta['kmers']), int(meta['occurrences'])
+        codes = np.memmap(os.path.join(path, 'codes.bin'), dtype='<u8', mode='r', shape=(kmers,)) if kmers else np.zeros(0, dtype=np.uint64)
+        offsets = np.fromfile(os.path.join(path, 'offsets.bin'), dtype='<i8')
+        positions = np.memmap(os.path.join(path, 'positions.bin'), dtype=np.dtype(meta['position_dtype']), mode='r', shape=(occurrences,)) \
+            if occurrences else np.zeros(0, dtype=np.int64)
+
+        return cls(int(meta['kmer_length']), meta['chr_name'], codes, offsets, positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def totals(self):
+        """Returns k-mer codes and numbers of their occurrences"""
+        return np.asarray(self.codes).astype(code_dtype(self.kmer_length)), np.diff(self.offsets)
+
+    def occurrences(self, start, end):
+        """Returns codes and positions of occurrences [start, end) of the index"""
+        rows = np.searchsorted(self.offsets, np.arange(start, end), side='right') - 1
+
+        return np.asarray(self.codes)[rows].astype(code_dtype(self.kmer_length)), self.positions[start:end].astype(np.int64)
+
+    def locate(self, code):
+        """Returns sorted positions of a single k-mer"""
+        row = np.searchsorted(self.codes, code)
+        if row == len(self.codes) or self.codes[row] != code:
+            return np.zeros(0, dtype=np.int64)
+
+        return self.positions[self.offsets[row]:self.offsets[row + 1]].astype(np.int64)
@@ -0,0 +1,54 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+# Arrays are aligned to cache lines within a block
+ALIGNMENT = 64
+
+
+class SharedArrays:
+    """Numpy arrays copied once into a single multiprocessing.shared_memory block.
+
+    Workers get only the small descriptor (the block name and the layout of its arrays) and attach to the block
+    without copying it, so the memory used does not grow with the number of workers. The creating process
+    releases the block with unlink()."""
+
+    def __init__(self, arrays):
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            size += -size % ALIGNMENT
+            layout[name] = (size, array.dtype.str, array.shape)
+            size += array.nbytes
+
+        self.block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.layout = layout
+
+        for name, array in arrays.items():
+            self.view(name)[...] = array
+
+    def view(self, name):
+        offset, dtype, shape = self.layout[name]
+
+        return np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=offset)
+
+    @property
+    def descriptor(self):
+        return {'block': self.block.name, 'layout': self.layout}
+
+    def unlink(self):
+        self.block.close()
+        self.block.unlink()
+
+
+def attach_arrays(descriptor):
+    """Attaches to a block created by SharedArrays. Returns a tuple (block, arrays); the arrays are read-only views
+    valid as long as the block is kept open."""
+    block = shared_memory.SharedMemory(name=descriptor['block'])
+
+    arrays = {}
+    for name, (offset, dtype, shape) in descriptor['layout'].items():
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+        arrays[name].flags.writeable = False
+
+    return block, arrays
@@ -0,0 +1,269 @@
+import os
+import heapq
+from itertools import groupby
+import numpy as np
+from app.kmer_codes import codes_to_kmers
+from app.io_utils import atomic_dir, tmp_path, replace_path, write_meta, read_meta
+
+# A sparse table is a directory holding CSR arrays of a k-mer count table:
+#   codes.bin   - uint64 k-mer codes of the rows, sorted (code order is the lexicographic k-mer order)
+#   totals.bin  - int64 total occurrences of the k-mers
+#   indptr.bin  - int64 row pointers, non-zero counts of the i-th row are stored between indptr[i] and indptr[i + 1]
+#   indices.bin - int32 column indices of the non-zero counts
+#   data.bin    - int64 non-zero counts
+#   columns.txt - column names, one per line
+#   meta.txt    - 'key=value' lines: kmer_length, rows, nnz and total_column (name of the totals column)
+ARRAY_DTYPES = {
+    'codes': np.dtype('<u8'),
+    'totals': np.dtype('<i8'),
+    'indptr': np.dtype('<i8'),
+    'indices': np.dtype('<i4'),
+    'data': np.dtype('<i8')
+}
+EXPORT_CHUNK_ROWS = 100000
+STREAM_CHUNK_ROWS = 100000
+# Largest dense merge matrix (rows x columns), 2**27 int64 cells take 1 GB
+DENSE_MERGE_MAX_CELLS = 2 ** 27
+
+
+def write_table_info(path, kmer_length, columns, rows, nnz, total_column):
+    with open(os.path.join(path, 'columns.txt'), 'w') as file:
+        file.write("".join(f'{column}\n' for column in columns))
+
+    write_meta(path, kmer_length=kmer_length, rows=rows, nnz=nnz, total_column=total_column)
+
+
+class SparseTable:
+    def __init__(self, kmer_length, columns, codes, totals, indptr, indices, data, total_column='total_occurences'):
+        self.kmer_length = kmer_length
+        self.columns = list(columns)
+        self.codes = codes
+        self.totals = totals
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.total_column = total_column
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_triplets(cls, kmer_length, columns, codes, totals, rows, cols, counts, total_column='total_occurences'):
+        """Builds a table from row codes (sorted), row totals and (row, column, count) triplets of non-zero counts"""
+        order = np.lexsort((cols, rows))
+        rows, cols, counts = rows[order], cols[order], counts[order]
+
+        keep = counts != 0
+        rows, cols, counts = rows[keep], cols[keep], counts[keep]
+
+        indptr = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(codes)), out=indptr[1:])
+
+        return cls(kmer_length, columns, np.asarray(codes, dtype=np.uint64), np.asarray(totals, dtype=np.int64), indptr,
+                   cols.astype(np.int32), counts.astype(np.int64), total_column)
+
+    @classmethod
+    def merge(cls, tables):
+        """Sums tables with the same columns row by row (rows are matched on k-mer codes). The merged table keeps
+        the header of the first table, as the text merger did."""
+        codes, inverse = np.unique(np.concatenate([np.asarray(table.codes) for table in tables]), return_inverse=True)
+
+        totals = np.zeros(len(codes), dtype=np.int64)
+        np.add.at(totals, inverse, np.concatenate([np.asarray(table.totals) for table in tables]))
+
+        table_rows = []
+        offset = 0
+        for table in tables:
+            table_rows.append(np.repeat(np.arange(offset, offset + len(table)), np.diff(table.indptr)))
+            offset += len(table)
+
+        rows = inverse[np.concatenate(table_rows)]
+        cols = np.concatenate([np.asarray(table.indices) for table in tables]).astype(np.int64)
+        counts = np.concatenate([np.asarray(table.data) for table in tables])
+
+        if len(counts):
+            order = np.lexsort((cols, rows))
+            rows, cols, counts = rows[order], cols[order], counts[order]
+            starts = np.flatnonzero(np.concatenate(([True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]))))
+            rows, cols, counts = rows[starts], cols[starts], np.add.reduceat(counts, starts)
+
+        return cls.from_triplets(tables[0].kmer_length, tables[0].columns, codes, totals, rows, cols, counts, tables[0].total_column)
+
+    @classmethod
+    def merge_dense(cls, tables, chunk_rows=STREAM_CHUNK_ROWS):
+        """Sums tables with the same columns in a dense (4**k x columns) matrix indexed by k-mer code.
+
+        Every table is added with a single bulk array addition and the merged rows come out in code order
+        without sorting. The merged table keeps the header of the first table."""
+        kmer_length, columns = tables[0].kmer_length, tables[0].columns
+        dense = np.zeros((4 ** kmer_length, len(columns)), dtype=np.int64)
+        totals = np.zeros(4 ** kmer_length, dtype=np.int64)
+        present = np.zeros(4 ** kmer_length, dtype=bool)
+
+        for table in tables:
+            codes = np.asarray(table.codes).astype(np.int64)
+            rows = np.repeat(codes, np.diff(table.indptr))
+
+            # Codes are unique within a table, so the (row, column) pairs of a single addition are unique too
+            dense[rows, table.indices] += table.data
+            totals[codes] += table.totals
+            present[codes] = True
+
+        codes = np.flatnonzero(present)
+        triplets = []
+        for start in range(0, len(codes), chunk_rows):
+            chunk_codes = codes[start:start + chunk_rows]
+            rows, cols = np.nonzero(dense[chunk_codes])
+            triplets.append((rows + start, cols, dense[chunk_codes[rows], cols]))
+
+        rows, cols, counts = [np.concatenate([triplet[i] for triplet in triplets]) if triplets else np.zeros(0, dtype=np.int64)
+                              for i in range(3)]
+
+        return cls.from_triplets(kmer_length, columns, codes.astype(np.uint64), totals[codes], rows, cols, counts,
+                                 tables[0].total_column)
+
+    def save(self, path):
+        # The table appears under its final name only when it is complete
+        with atomic_dir(path) as tmp:
+            for name, dtype in ARRAY_DTYPES.items():
+                np.asarray(getattr(self, name), dtype=dtype).tofile(os.path.join(tmp, f'{name}.bin'))
+
+            write_table_info(tmp, self.kmer_length, self.columns, len(self.codes), len(self.data), self.total_column)
+
+    @classmethod
+    def load(cls, path):
+        """Opens a saved table. Arrays are memory-mapped, so only the accessed rows are read from disk."""
+        meta = read_meta(path)
+
+        with open(os.path.join(path, 'columns.txt'), 'r') as file:
+            columns = file.read().splitlines()
+
+        rows, nnz = int(meta['rows']), int(meta['nnz'])
+        sizes = {'codes': rows, 'totals': rows, 'indptr': rows + 1, 'indices': nnz, 'data': nnz}
+
+        arrays = {}
+        for name, dtype in ARRAY_DTYPES.items():
+            if sizes[name]:
+                arrays[name] = np.memmap(os.path.join(path, f'{name}.bin'), dtype=dtype, mode='r', shape=(sizes[name],))
+            else:
+                arrays[name] = np.zeros(0, dtype=dtype)
+
+        return cls(int(meta['kmer_length']), columns, arrays['codes'], arrays['totals'], arrays['indptr'],
+                   arrays['indices'], arrays['data'], meta['total_column'])
+
+    def iter_rows(self, chunk_rows=STREAM_CHUNK_ROWS):
+        """Yields rows as tuples (code, total, column indices, counts), reading at most 'chunk_rows' rows at once"""
+        for start in range(0, len(self.codes), chunk_rows):
+            stop = min(start + chunk_rows, len(self.codes))
+            indptr = (self.indptr[start:stop + 1] - self.indptr[start]).tolist()
+            first, last = self.indptr[start], self.indptr[stop]
+            indices = self.indices[first:last].tolist()
+            data = self.data[first:last].tolist()
+
+            for i, (code, total) in enumerate(zip(self.codes[start:stop].tolist(), self.totals[start:stop].tolist())):
+                yield code, total, indices[indptr[i]:indptr[i + 1]], data[indptr[i]:indptr[i + 1]]
+
+    def to_dense(self, start=0, stop=None):
+        """Returns rows [start, stop) as a dense (rows x columns) array"""
+        stop = len(self.codes) if stop is None else min(stop, len(self.codes))
+        first, last = self.indptr[start], self.indptr[stop]
+
+        dense = np.zeros((stop - start, len(self.columns)), dtype=np.int64)
+        rows = np.repeat(np.arange(stop - start), np.diff(self.indptr[start:stop + 1]))
+        dense[rows, self.indices[first:last]] = self.data[first:last]
+
+        return dense
+
+    def export_tsv(self, path, chunk_rows=EXPORT_CHUNK_ROWS):
+        """Writes the table in the tab-separated text layout: k-mer, total occurrences and one column per count"""
+        with open(path, 'w') as file:
+            file.write("\t".join(["k-mer", self.total_column] + self.columns) + "\n")
+
+            for start in range(0, len(self.codes), chunk_rows):
+                stop = min(start + chunk_rows, len(self.codes))
+                kmers = codes_to_kmers(self.codes[start:stop], self.kmer_length)
+
+                for kmer, total, values in zip(kmers, self.totals[start:stop].tolist(), self.to_dense(start, stop).tolist()):
+                    file.write(kmer + "\t" + str(total) + "\t" + "\t".join(map(str, values)) + "\n")
+
+
+class SparseTableWriter:
+    """Writes a sparse table row by row. Rows must be added in k-mer code order; they are buffered and flushed
+    to the array files every 'chunk_rows' rows, so memory use does not depend on the size of the table."""
+
+    def __init__(self, path, kmer_length, columns, total_column='total_occurences', chunk_rows=STREAM_CHUNK_ROWS):
+        self.path = path
+        self.tmp_path = tmp_path(path)
+        self.kmer_length = kmer_length
+        self.columns = list(columns)
+        self.total_column = total_column
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self.nnz = 0
+
+        os.mkdir(self.tmp_path)
+        self.files = {name: open(os.path.join(self.tmp_path, f'{name}.bin'), 'wb') for name in ARRAY_DTYPES.keys()}
+        self.files['indptr'].write(np.zeros(1, dtype=ARRAY_DTYPES['indptr']).tobytes())
+        self.buffer = {name: [] for name in ARRAY_DTYPES.keys()}
+
+    def add_row(self, code, total, indices, data):
+        self.buffer['codes'].append(code)
+        self.buffer['totals'].append(total)
+        self.buffer['indices'].extend(indices)
+        self.buffer['data'].extend(data)
+        self.nnz += len(data)
+        self.buffer['indptr'].append(self.nnz)
+
+        if len(self.buffer['codes']) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        self.rows += len(self.buffer['codes'])
+
+        for name, dtype in ARRAY_DTYPES.items():
+            self.files[name].write(np.array(self.buffer[name], dtype=dtype).tobytes())
+            self.buffer[name] = []
+
+    def close(self):
+        self.flush()
+
+        for file in self.files.values():
+            file.close()
+
+        write_table_info(self.tmp_path, self.kmer_length, self.columns, self.rows, self.nnz, self.total_column)
+        replace_path(self.tmp_path, self.path)
+
+
+def merge_streaming(tables, path, chunk_rows=STREAM_CHUNK_ROWS):
+    """Sums tables with the same columns into a table saved at 'path' with a heap-based k-way merge of their rows.
+
+    Tables are read and the merged table is written in chunks, so only a few chunks of rows are held in memory
+    regardless of the number of k-mers and tables. The merged table keeps the header of the first table."""
+    writer = SparseTableWriter(path, tables[0].kmer_length, tables[0].columns, tables[0].total_column, chunk_rows)
+    rows = heapq.merge(*[table.iter_rows(chunk_rows) for table in tables], key=lambda row: row[0])
+
+    for code, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+
+        if len(group) == 1:
+            writer.add_row(*group[0])
+            continue
+
+        total = 0
+        counts = {}
+        for _, row_total, indices, data in group:
+            total += row_total
+            for index, count in zip(indices, data):
+                counts[index] = counts.get(index, 0) + count
+
+        indices = sorted(index for index, count in counts.items() if count != 0)
+        writer.add_row(code, total, indices, [counts[index] for index in indices])
+
+    writer.close()
+
+    return writer.rows
+
+
+def dense_merge_fits(kmer_length, columns_number):
+    """Checks if tables of the given shape can be merged in a dense matrix"""
+    return kmer_length <= 12 and 4 ** kmer_length * columns_number <= DENSE_MERGE_MAX_CELLS
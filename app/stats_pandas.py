@@ -1,8 +1,15 @@
 import os
-import scipy.stats as stats
+import numpy as np
 import pandas as pd
-from statsmodels.sandbox.stats.multicomp import multipletests
+from statsmodels.stats.multitest import multipletests
 from app.text_formating import red, green, print_info, print_warning, print_logo
+from app.genome_catalog import GenomeCatalog
+from app.annotation import AnnotationStore
+from app.sparse_table import SparseTable, EXPORT_CHUNK_ROWS
+from app.kmer_codes import codes_to_kmers, kmers_to_codes
+from app.coords_index import CoordsIndex
+from app.manifest import stats_manifest
+from app.fisher_test import PValueCache
 import datetime
 # EXAMPLE: multipletests([0.01, 0.02, 0.03], method='bonferroni')
 # RETURNS: (array([ True, False, False]), array([0.03, 0.06, 0.09]), 0.016952427508441503, 0.016666666666666666)
@@ -20,7 +27,7 @@ class Stat:
         self.mite_names = {}
         self.column_names = ["mite_total_len", "mite", "out", "freq", "fisher_exac_p"]
         self.data = pd.DataFrame(columns=self.column_names)
-        self.merged_table_path = os.path.join(parameters['output_dir'], 'tables', 'table_merged.txt')
+        self.merged_table_path = os.path.join(parameters['output_dir'], 'tables', 'table_merged.sparse')
         self.output_path = os.path.join(parameters['output_dir'], 'stats', 'stats.txt')
 
         if not os.path.exists(os.path.join(parameters['output_dir'], 'stats')):
@@ -40,8 +47,10 @@ class Stat:
             print_warning("the merged table does not exist")
             return False
 
-        if not os.path.exists(os.path.join(self.parameters['output_dir'], 'stats', 'stats.txt')) \
-                or (os.path.exists(os.path.join(self.parameters['output_dir'], 'stats', 'stats.txt')) and self.parameters['keep_stats_file'] == 'no'):
+        # Test results are reused only if they were computed from the same merged table
+        manifest = stats_manifest(self.parameters)
+
+        if not manifest.is_done() or self.parameters['keep_stats_file'] == 'no':
             try:
                 print_info("Applying Fisher test ...")
                 self.chrom_len_calc()
@@ -49,11 +58,13 @@ class Stat:
                 self.analyse()
 
                 self.save_stats_to_file(os.path.join(self.parameters['output_dir'], 'stats', 'stats.txt'))
+                manifest.record()
             except Exception:
                 return False
         else:
-            print_info(f"The output 'stats.txt' file exists. Loading saved data ... ")
-            self.data = pd.read_csv(os.path.join(self.parameters['output_dir'], 'stats', 'stats.txt'), sep='\t')
+            print_info(f"The output 'stats.txt' file is up to date. Loading saved data ... ")
+            self.chrom_len_calc()
+            self.data = pd.read_csv(os.path.join(self.parameters['output_dir'], 'stats', 'stats.txt'), sep='\t', index_col=0)
 
         try:
             print("")
@@ -67,7 +78,6 @@ class Stat:
             self.filter_kmers_by_freq_lesser()
             self.save_stats_to_file(os.path.join(self.parameters['output_dir'], 'stats', 'stats_filtered_3_by_freq_lesser.txt'))
 
-            self.merge_coords_files()
             self.filter_coords_file()
 
             return True
@@ -76,85 +86,87 @@ class Stat:
             return False
 
     def chrom_len_calc(self):
-        for prefix in self.parameters['prefixes']:
-            with open(os.path.join(self.parameters['data_dir'], f'{prefix}_oneLine.txt')) as file:
-                line_len = 0
+        catalog = GenomeCatalog.load(self.parameters['data_dir'])
 
-                for line in file:
-                    line = line.rstrip()
-                    line_len += len(line)
+        for prefix in self.parameters['prefixes']:
+            chrom_len = catalog.length(prefix)
 
-                self.chrom_len[prefix] = line_len
-                self.total_genome_len += line_len
+            self.chrom_len[prefix] = chrom_len
+            self.total_genome_len += chrom_len
 
     def mite_total_len_calc(self):
-        with open(self.parameters['bed_file'], 'r') as f:
-            for line in f:
-                line = line.rstrip()
-
-                line_spliced = line.split('\t')
-
-                try:
-                    self.mite_total_len[line_spliced[-1]] += ( int(line_spliced[2]) - int(line_spliced[1]) + 1)
-                except KeyError:
-                    self.mite_total_len[line_spliced[-1]] = ( int(line_spliced[2]) - int(line_spliced[1]) + 1)
-
-    def get_number_of_lines(self, file_name):
-        with open(file_name, 'r') as file:
-            for line_index, _ in enumerate(file):
-                pass
-
-        return line_index + 1
+        annotation, _ = AnnotationStore.open(self.parameters['bed_file'], self.parameters['cache_dir'])
+        self.mite_total_len = annotation.family_total_lengths()
 
     def analyse(self):
-        with open(self.merged_table_path, 'r') as f:
-            number_of_lines = self.get_number_of_lines(self.merged_table_path)
+        table = SparseTable.load(self.merged_table_path)
+        number_of_rows = len(table)
+
+        family_lengths = np.zeros(len(table.columns), dtype=np.int64)
+        for i, column in enumerate(table.columns[:-2]):
+            if column[-5:] != "_edge":
+                self.index.append(i)
+                self.mite_names[i] = column
+                family_lengths[i] = self.mite_total_len[column]
+
+        chunks = []
+        for start in range(0, number_of_rows, EXPORT_CHUNK_ROWS):
+            stop = min(start + EXPORT_CHUNK_ROWS, number_of_rows)
+            chunks.append(self.contingency_tables(table, start, stop, family_lengths))
+            self.progress_bar(stop, number_of_rows)
+
+        codes, mite_total_len, mite, total = [np.concatenate([chunk[i] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+                                              for i in range(4)]
+
+        # 2x2 tables [[mite, out], [a, b]]: the observed k-mer counts and the counts expected from the MITE length
+        a = np.round((mite_total_len / self.total_genome_len) * total).astype(np.int64)
+        b = np.round(((self.total_genome_len - mite_total_len) / self.total_genome_len) * total).astype(np.int64)
+        out = total - mite
+        freq = mite / (mite + out)
 
-            for line_numer, line in enumerate(f):
-                self.progress_bar(line_numer + 1, number_of_lines)
-
-                line = line.rstrip()
+        print("")
+        print_info(f"Computing p-values of {len(codes)} k-mers ...")
+        pvalue_cache = self.open_pvalue_cache()
+        p = pvalue_cache.fisher_exact(mite, out, a, b)
+        print_info(f"P-value cache: {pvalue_cache.report()}")
+        pvalue_cache.save()
 
-                kmers_in_mites_normalized = []
-                kmers_out_mites_normalized = []
-                kmers_in_mites_total_sum = 0
-                mite_total_len_int = 0
+        self.data = pd.DataFrame({"mite_total_len": mite_total_len, "mite": mite, "out": out, "freq": freq, "fisher_exac_p": p},
+                                 index=codes_to_kmers(codes, table.kmer_length), columns=self.column_names)
 
-                line_spliced = line.split('\t')
+        corrected_p = multipletests(list(self.data['fisher_exac_p']), method='bonferroni')[self.BONFERRONI_OUT_INDEX]
 
-                if line_spliced[0] == "k-mer":
-                    for i in range(2, len(line_spliced) - 2):
-                        if line_spliced[i][-5:] != "_edge":
-                            self.index.append(i)
-                            self.mite_names[i] = line_spliced[i]
-                else:
-                    kmerName = line_spliced[0]
-                    kmerTotalOccurences = int(line_spliced[1])
-                    for i in self.index:
-                        if int(line_spliced[i]) > 0:
-                            kmers_in_mites_total_sum += int(line_spliced[i])
-                            mite_total_len_int += self.mite_total_len[self.mite_names[i]]
+        self.data['p_corrected_bon'] = corrected_p
 
-                    if mite_total_len_int > 0:
-                        a = round( (mite_total_len_int / self.total_genome_len) * kmerTotalOccurences )
-                        b = round( ((self.total_genome_len - mite_total_len_int) / self.total_genome_len) * kmerTotalOccurences )
+    def open_pvalue_cache(self):
+        """Returns the p-value cache, persisted in the cache directory unless disabled with 'pvalue_cache=no'"""
+        if self.parameters.get('pvalue_cache', 'yes') == 'no':
+            return PValueCache()
 
-                        kmers_in_out_total_sum = kmerTotalOccurences - kmers_in_mites_total_sum
+        if not os.path.exists(self.parameters['cache_dir']):
+            os.makedirs(self.parameters['cache_dir'])
 
-                        # print(kmerTotalOccurences, kmers_in_mites_total_sum)
+        return PValueCache(os.path.join(self.parameters['cache_dir'], 'fisher_pvalues.npz'))
 
-                        _, p = stats.fisher_exact([[kmers_in_mites_total_sum, kmers_in_out_total_sum], [a, b]])
+    def contingency_tables(self, table, start, stop, family_lengths):
+        """Sums counts and lengths of the MITE families present in rows [start, stop) of the merged table.
 
-                        freq = kmers_in_mites_total_sum / (kmers_in_mites_total_sum + kmers_in_out_total_sum)
+        Returns a tuple of arrays (codes, MITE total length, k-mers in MITEs, total k-mers) of the rows with
+        at least one occurrence in a MITE."""
+        first, last = table.indptr[start], table.indptr[stop]
+        rows = np.repeat(np.arange(stop - start), np.diff(table.indptr[start:stop + 1]))
+        indices = np.asarray(table.indices[first:last])
+        data = np.asarray(table.data[first:last])
 
-                        row = pd.Series([mite_total_len_int, kmers_in_mites_total_sum, kmers_in_out_total_sum, freq, p],
-                                        name=kmerName, index=self.column_names)
-                        self.data = self.data.append(row)
+        in_family = (family_lengths[indices] > 0) & (data > 0)
+        mite = np.zeros(stop - start, dtype=np.int64)
+        mite_total_len = np.zeros(stop - start, dtype=np.int64)
+        np.add.at(mite, rows[in_family], data[in_family])
+        np.add.at(mite_total_len, rows[in_family], family_lengths[indices[in_family]])
 
-        print("")
-        corrected_p = multipletests(list(self.data['fisher_exac_p']), method='bonferroni')[self.BONFERRONI_OUT_INDEX]
+        kept = np.flatnonzero(mite_total_len > 0)
 
-        self.data['p_corrected_bon'] = corrected_p
+        return table.codes[start:stop][kept], mite_total_len[kept], mite[kept], np.asarray(table.totals[start:stop])[kept]
 
     def filter_kmers_by_p_corrected_bon_thresh(self):
         print(f"- filtering by bonferoni ... ", end='')
@@ -187,24 +199,15 @@ class Stat:
 
         return self.data
 
-    def merge_coords_files(self):
-        with open(os.path.join(self.parameters['output_dir'], 'tables', 'table_coords_merged.txt'), 'w') as output:
-            for prefix in self.parameters['prefixes']:
-                with open(os.path.join(self.parameters['output_dir'], 'tables', f'table_{prefix}_coords.txt'), 'r') as file:
-                    for line in file:
-                        output.write(line)
-
     def filter_coords_file(self):
-        kmers = dict.fromkeys(list(self.data.index), 0)
+        """Writes coordinates of the selected k-mers. Records of every k-mer are read from the per-chromosome
+        offset index, so only the selected byte ranges of the coordinate files are read."""
+        codes = kmers_to_codes(list(self.data.index), int(self.parameters['kmer_length']))
 
         with open(os.path.join(self.parameters['output_dir'], 'tables', 'table_coords_merged_filtered.txt'), 'w') as output:
-            with open(os.path.join(self.parameters['output_dir'], 'tables', 'table_coords_merged.txt'), 'r') as file:
-                for line in file:
-                    line_splitted = line.rstrip().split("\t")
-                    kmer = line_splitted[3].split(";")[0]
-
-                    if kmer in kmers:
-                        output.write(line)
+            for prefix in self.parameters['prefixes']:
+                coords = CoordsIndex.load(os.path.join(self.parameters['output_dir'], 'tables', f'table_{prefix}.coords'))
+                coords.write_tsv(output, codes)
 
     def save_stats_to_file(self, filename):
         print_info(f"Saving data to file '{os.path.basename(filename)}'")
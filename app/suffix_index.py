@@ -0,0 +1,200 @@
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+from app.text_formating import print_info, print_logo, print_warning
+from app.kmer_codes import encode_sequence, INVALID_BASE
+from app.io_utils import atomic_file
+from app.chromosome_cache import open_chromosome_cache
+from app.genome_catalog import GenomeCatalog
+from app.manifest import StageManifest, chromosome_fingerprint
+from app.occurrence_index import INDEX_DIR
+
+# A suffix index of a chromosome is its suffix array saved as a '.npy' file (int32, or int64 for chromosomes
+# longer than 2 Gbp) next to the occurrence indexes. Together with the chromosome cache it locates a sequence of
+# any length with two binary searches, i.e. in O(m log n + occ) time for a sequence of length m.
+
+# Number of leading bases packed into the initial sort keys (base 6: end of the chromosome, A, C, G, T, others)
+PACKED_BASES = 24
+
+
+def suffix_index_path(parameters, prefix):
+    return os.path.join(parameters['output_dir'], INDEX_DIR, f'{prefix}.sa.npy')
+
+
+def suffix_index_manifest(parameters, prefix, catalog):
+    inputs = {'chromosome': chromosome_fingerprint(catalog, prefix)}
+
+    return StageManifest(parameters, f'suffix_index_{prefix}', inputs, [suffix_index_path(parameters, prefix)])
+
+
+def refine_ranks(ranks, suffixes, keys):
+    """Sorts suffixes of unresolved groups by their keys (the group rank comes first in every key).
+
+    A suffix is ranked by the position of its group in the sorted order, so groups split in place and the
+    new ranks of all suffixes stay consistent. Returns the suffixes which still share their rank."""
+    order = np.argsort(keys, kind='stable')
+    suffixes, keys = suffixes[order], keys[order]
+    indices = np.arange(len(suffixes))
+
+    group_starts = np.concatenate(([True], ranks[suffixes][1:] != ranks[suffixes][:-1]))
+    key_starts = np.concatenate(([True], keys[1:] != keys[:-1]))
+    ranks[suffixes] = ranks[suffixes] + np.maximum.accumulate(np.where(key_starts, indices, 0)) - \
+        np.maximum.accumulate(np.where(group_starts, indices, 0))
+
+    singles = key_starts & np.concatenate((key_starts[1:], [True]))
+
+    return suffixes[~singles]
+
+
+def suffix_array(encoded):
+    """Builds the suffix array of an encoded sequence by prefix doubling.
+
+    Suffixes are first ranked by their PACKED_BASES leading bases, then every round sorts the suffixes sharing a
+    rank by pairs of ranks (rank of the suffix, rank of the suffix 'h' positions later), doubling the sorted prefix
+    length h until all ranks differ. Positions past the end rank below every base, so a suffix precedes its
+    extensions."""
+    length = len(encoded)
+    dtype = np.int32 if length < 2 ** 31 else np.int64
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+
+    symbols = np.zeros(length + PACKED_BASES, dtype=np.int64)
+    symbols[:length] = np.asarray(encoded, dtype=np.int64) + 1
+
+    keys = np.zeros(length, dtype=np.int64)
+    for offset in range(PACKED_BASES):
+        keys *= INVALID_BASE + 2
+        keys += symbols[offset:offset + length]
+
+    ranks = np.ones(length, dtype=np.int64)
+    unresolved = refine_ranks(ranks, np.arange(length, dtype=np.int64), keys)
+    step = PACKED_BASES
+
+    while len(unresolved) and step < length:
+        following = np.zeros(len(unresolved), dtype=np.int64)
+        inside = unresolved + step < length
+        following[inside] = ranks[unresolved[inside] + step]
+
+        if (length + 1) ** 2 < 2 ** 63:
+            keys = ranks[unresolved] * (length + 1) + following
+        else:
+            # Rank pairs do not fit a single integer: keys are positions of the pairs in their sorted order
+            keys = np.empty(len(unresolved), dtype=np.int64)
+            keys[np.lexsort((following, ranks[unresolved]))] = np.arange(len(unresolved))
+
+        unresolved = refine_ranks(ranks, unresolved, keys)
+        step *= 2
+
+    suffixes = np.empty(length, dtype=dtype)
+    suffixes[ranks - 1] = np.arange(length, dtype=dtype)
+
+    return suffixes
+
+
+def build_suffix_index(task):
+    """Builds and saves the suffix index of a single chromosome. Returns a tuple (prefix, error)."""
+    prefix, chr_file, index_file = task
+
+    try:
+        sequence, _ = open_chromosome_cache(chr_file)
+        array = suffix_array(sequence)
+
+        with atomic_file(index_file) as tmp_file, open(tmp_file, 'wb') as file:
+            np.save(file, array)
+    except Exception as e:
+        return prefix, e
+
+    return prefix, None
+
+
+def build_suffix_indexes(parameters):
+    """Builds suffix indexes of all chromosomes (in parallel). Up-to-date indexes are kept."""
+    print_logo("Suffix index")
+
+    catalog = GenomeCatalog.load(parameters['data_dir'])
+    index_dir = os.path.join(parameters['output_dir'], INDEX_DIR)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    manifests = {}
+    tasks = []
+    for prefix in parameters['prefixes']:
+        manifests[prefix] = suffix_index_manifest(parameters, prefix, catalog)
+        if manifests[prefix].is_done():
+            print_info(f'Keeping the suffix index of {prefix} from the previous run')
+            continue
+
+        tasks.append((prefix, os.path.join(parameters['data_dir'], f'{prefix}_chrom.bin'), suffix_index_path(parameters, prefix)))
+
+    if len(tasks) == 0:
+        return True
+
+    start = time.time()
+    with Pool(min(int(parameters['threads_number']), len(tasks))) as pool:
+        for prefix, error in pool.imap_unordered(build_suffix_index, tasks):
+            if error is not None:
+                print_warning(f'Something went wrong during building the suffix index of {prefix}.')
+                print(error)
+
+                return False
+
+            manifests[prefix].record()
+            print_info(f'Suffix index of {prefix} built')
+
+    print_info(f'Suffix indexes built in {time.time() - start:.2f} sek')
+
+    return True
+
+
+class SuffixIndex:
+    def __init__(self, chr_name, sequence, suffixes):
+        self.chr_name = chr_name
+        self.sequence = sequence
+        self.suffixes = suffixes
+
+    @classmethod
+    def load(cls, parameters, prefix):
+        """Opens the suffix index of a chromosome. The suffix array and the chromosome are memory-mapped."""
+        sequence, _ = open_chromosome_cache(os.path.join(parameters['data_dir'], f'{prefix}_chrom.bin'))
+        suffixes = np.load(suffix_index_path(parameters, prefix), mmap_mode='r')
+
+        return cls(prefix, sequence, suffixes)
+
+    def bound(self, pattern, upper):
+        """Returns the first suffix whose prefix is greater than (upper) or not less than (lower) the pattern"""
+        lo, hi = 0, len(self.suffixes)
+
+        while lo < hi:
+            middle = (lo + hi) // 2
+            position = int(self.suffixes[middle])
+            prefix = self.sequence[position:position + len(pattern)].tobytes()
+
+            if prefix < pattern or (upper and prefix == pattern):
+                lo = middle + 1
+            else:
+                hi = middle
+
+        return lo
+
+    def suffix_range(self, kmer):
+        """Returns the range [first, last) of the suffix array holding the occurrences of a k-mer (in upper or
+        lower case; soft-masked positions of the chromosome never match)"""
+        pattern = encode_sequence(kmer.upper())
+        if len(pattern) == 0 or np.any(pattern >= INVALID_BASE):
+            raise ValueError(f'k-mers can contain only A, C, G and T characters ({kmer})')
+
+        pattern = pattern.tobytes()
+
+        return self.bound(pattern, False), self.bound(pattern, True)
+
+    def count(self, kmer):
+        first, last = self.suffix_range(kmer)
+
+        return last - first
+
+    def locate(self, kmer):
+        """Returns sorted start positions of all occurrences of a k-mer of any length"""
+        first, last = self.suffix_range(kmer)
+
+        return np.sort(np.asarray(self.suffixes[first:last], dtype=np.int64))
@@ -1,14 +1,19 @@
-import re
-import numpy as np
 import os
 from app.text_formating import red, green, print_logo, print_info, print_warning
+from app.manifest import table_merger_manifest
+from app.sparse_table import SparseTable, merge_streaming, dense_merge_fits
+from app.io_utils import atomic_file, remove_path
 
 
 class TableMerger:
     def __init__(self, parameters):
         self.parameters = parameters
         self.output_path = os.path.join(self.parameters['output_dir'], 'tables')
-        self.merged_data = {}
+        self.merged_table_path = os.path.join(self.output_path, 'table_merged.sparse')
+        self.merged_tsv_path = os.path.join(self.output_path, 'table_merged.txt')
+        self.merged_data = None
+        self.manifest = None
+        self.merge_mode = self.parameters.get('merge_mode', 'auto')
 
     def run(self):
         print_logo("Merging tables")
@@ -19,42 +24,39 @@ class TableMerger:
         try:
             if self.merge_tables():
                 self.write_merged_tables()
+                self.manifest.record()
 
             return True
         except Exception:
             return False
 
     def merge_tables(self):
-        lineSplit = re.compile(r'\t')
-
-        if (os.path.exists(os.path.join(self.output_path, 'table_merged.txt'))):
-            os.remove(os.path.join(self.output_path, 'table_merged.txt'))
-
         tables = self.get_all_table_files()
         if len(tables) == 0:
             print_warning("There is no tables to merge")
             return False
 
+        data = []
         for table in tables:
             print_info(f"Reading {table} ...")
-
-            with open(os.path.join(self.output_path, table), 'r') as f:
-                while True:
-                    line = f.readline()
-                    if line == "":
-                        break
-
-                    line = line.rstrip()
-                    line_splitted = lineSplit.split(line)
-                    if line_splitted[0] == "k-mer":
-                        self.merged_data["header"] = line
-                        continue
-
-                    line_splitted[1:] = list(map(int, line_splitted[1:]))
-                    try:
-                        self.merged_data[line_splitted[0]] += np.array(line_splitted[1:])
-                    except KeyError:
-                        self.merged_data[line_splitted[0]] = np.array(line_splitted[1:])
+            data.append(SparseTable.load(os.path.join(self.output_path, table)))
+
+        merge_mode = self.merge_mode
+        if merge_mode == 'auto':
+            merge_mode = 'dense' if dense_merge_fits(data[0].kmer_length, len(data[0].columns)) else 'streaming'
+            print_info(f"Selected the {merge_mode} merge mode")
+
+        if merge_mode == 'dense':
+            # Small k: rows are summed in a matrix indexed by k-mer code, one bulk addition per table
+            self.merged_data = SparseTable.merge_dense(data)
+        elif merge_mode == 'streaming':
+            # Tables are sorted by k-mer code, so they are merged row by row straight into the output table
+            print_info(f"Merging {len(data)} tables in the streaming mode ...")
+            rows_number = merge_streaming(data, self.merged_table_path)
+            print_info(f"Merged table holds {rows_number} k-mers")
+        else:
+            # Rows are matched on integer k-mer codes and summed in bulk
+            self.merged_data = SparseTable.merge(data)
 
         print_info(f"Merging completed")
 
@@ -63,25 +65,36 @@ class TableMerger:
     def get_all_table_files(self):
         tables = []
 
-        for file in os.listdir(self.output_path):
-            if file.split("_")[-1] in self.parameters['prefixes']:
-                tables.append(file)
+        for prefix in self.parameters['prefixes']:
+            if os.path.exists(os.path.join(self.output_path, f'table_{prefix}.sparse')):
+                tables.append(f'table_{prefix}.sparse')
 
         return tables
 
     def write_merged_tables(self):
-        with open(os.path.join(self.output_path, "table_merged.txt"), 'a+') as f:
-            f.write(self.merged_data.pop("header", None) + "\n")
+        if self.merged_data is not None:
+            self.merged_data.save(self.merged_table_path)
 
-            for kmer in sorted(self.merged_data.keys()):
-                f.write(kmer + "\t" + "\t".join(list(map(str, self.merged_data[kmer]))) + "\n")
+        if self.parameters.get('export_tsv_tables', 'no') == 'yes':
+            self.export_tsv_table()
+        else:
+            # A text table of a previous run would not match the new binary one
+            remove_path(self.merged_tsv_path)
+
+    def export_tsv_table(self):
+        print_info(f"Exporting merged table to 'table_merged.txt' ...")
+        with atomic_file(self.merged_tsv_path) as tmp_file:
+            SparseTable.load(self.merged_table_path).export_tsv(tmp_file)
 
     def check_run(self):
-        if not os.path.exists(os.path.join(self.parameters['output_dir'], 'tables', 'table_merged.txt')):
-            return True
+        self.manifest = table_merger_manifest(self.parameters)
 
-        if self.parameters['keep_kmers_merged_table'] == 'yes':
+        if self.parameters['keep_kmers_merged_table'] == 'yes' and self.manifest.is_done():
             print_info("Keeping merged table from the previous run")
+
+            # The text table is not a part of the manifest, it is exported from the kept binary table
+            if self.parameters.get('export_tsv_tables', 'no') == 'yes' and not os.path.exists(self.merged_tsv_path):
+                self.export_tsv_table()
             return False
 
-        return True
\ No newline at end of file
+        return True
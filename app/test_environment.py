@@ -4,9 +4,10 @@ import pkg_resources
 from app.text_formating import red, green, print_logo
 
 JELLYFISH_OUT_DIR = 'jellyfish'
+CACHE_DIR = 'cache'
 
 PIP_REQUIREMENTS = [
-    "intervaltree",
+    "numpy",
     "scipy",
     "pandas",
     "statsmodels"
@@ -14,7 +15,6 @@ PIP_REQUIREMENTS = [
 
 SOFT_REQUIREMENTS = [
     "jellyfish",
-    "iupac2meme",
     "tomtom"
 ]
 
@@ -34,10 +34,15 @@ def read_config(config_file):
                 value = value.split(',')
             parameters[key] = value
 
+    parameters.setdefault('counting_backend', 'jellyfish')
+
     if not os.path.exists(parameters["output_dir"]):
         os.mkdir(parameters["output_dir"])
 
     parameters['jellyfish_out_dir'] = os.path.join(parameters["output_dir"], JELLYFISH_OUT_DIR)
+    # FASTA files written for jellyfish and the cache (annotation stores, p-values) are shared by all k-mer lengths
+    parameters['jellyfish_fasta_dir'] = parameters['jellyfish_out_dir']
+    parameters['cache_dir'] = os.path.join(parameters["output_dir"], CACHE_DIR)
 
     if not os.path.exists(parameters['jellyfish_out_dir']):
         os.mkdir(parameters['jellyfish_out_dir'])
@@ -45,11 +50,40 @@ def read_config(config_file):
     return parameters
 
 
-def soft_check():
+def kmer_lengths(parameters):
+    """Returns the k-mer lengths of the 'kmer_length' parameter (a single length or a comma-separated list), sorted"""
+    return sorted({int(value) for value in str(parameters['kmer_length']).split(',')})
+
+
+def kmer_parameters(parameters, kmer_length):
+    """Returns the parameters of a single k-mer length.
+
+    With several k-mer lengths every length gets its own 'k<length>' subdirectory of the output directory (and
+    of the jellyfish directory), holding its tables, statistics and tomtom results. The cache directory stays
+    shared."""
+    if len(kmer_lengths(parameters)) == 1:
+        return parameters
+
+    k_parameters = dict(parameters)
+    k_parameters['kmer_length'] = str(kmer_length)
+    k_parameters['output_dir'] = os.path.join(parameters['output_dir'], f'k{kmer_length}')
+    k_parameters['jellyfish_out_dir'] = os.path.join(parameters['jellyfish_out_dir'], f'k{kmer_length}')
+
+    for directory in (k_parameters['output_dir'], k_parameters['jellyfish_out_dir']):
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+    return k_parameters
+
+
+def soft_check(parameters):
     output = True
     print(f'Checking required software ...')
 
     for soft in SOFT_REQUIREMENTS:
+        if soft == 'jellyfish' and parameters['counting_backend'] == 'builtin':
+            continue
+
         print(f'- {soft} ... ', end='', flush=True)
         if which(soft):
             print(green('ok'))
@@ -80,9 +114,9 @@ def pip_check():
     return output
 
 
-def test():
+def test(parameters):
     print_logo("Checking environment")
     pip_output = pip_check()
-    soft_output = soft_check()
+    soft_output = soft_check(parameters)
 
     return pip_output is True and soft_output is True
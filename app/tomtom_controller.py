@@ -1,17 +1,31 @@
 import os
+import glob
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from statsmodels.stats.multitest import multipletests
 from app.text_formating import red, green, print_info, print_warning, print_logo
+from app.meme_writer import write_meme
+from app.manifest import tomtom_manifest
+
+TOMTOM_COLUMNS = ['Query_ID', 'Target_ID', 'Optimal_offset', 'p-value', 'E-value', 'q-value', 'Overlap',
+                  'Query_consensus', 'Target_consensus', 'Orientation']
 
 
 class Tomtom:
     def __init__(self, parameters):
         self.parameters = parameters
-        self.stats_file_path = os.path.join(self.parameters['output_dir'], 'stats', 'stats.txt')
+        # k-mers which passed all filters of the statistic analysis
+        self.stats_file_path = os.path.join(self.parameters['output_dir'], 'stats', 'stats_filtered_3_by_freq_lesser.txt')
 
         if not os.path.exists(os.path.join(self.parameters['output_dir'], 'tomtom')):
             os.mkdir(os.path.join(self.parameters['output_dir'], 'tomtom'))
 
         self.output_meme_file_path = os.path.join(self.parameters['output_dir'], 'tomtom', "kmers.meme")
+        self.shards_dir = os.path.join(self.parameters['output_dir'], 'tomtom', 'shards')
+        self.output_dir = os.path.join(self.parameters['output_dir'], 'tomtom', 'tomtom_out')
+        self.output_tsv_file_path = os.path.join(self.output_dir, 'tomtom.tsv')
 
     def run(self):
         print_logo("K-mer comparing")
@@ -20,33 +34,30 @@ class Tomtom:
             print_info("Analysis canceled. To run tomtom set 'run_tomtom' parameter to 'yes'")
             return True
 
-        self.kmers_to_meme()
-        self.tomtom()
+        kmers = self.kmers_to_meme()
 
-        return True
+        return self.tomtom(kmers)
 
     def kmers_to_meme(self):
         """Converts kmer sequences into MEME format and saves them to the 'kmers.meme' file"""
-
-        if os.path.exists(self.output_meme_file_path):
-            os.remove(self.output_meme_file_path)
-
         print_info(f"Converting kmers into MEME format ... ")
 
-        with open(self.output_meme_file_path, 'a+') as output:
-            with open(self.stats_file_path, 'r') as file:
-                for line in file:
-                    line = line.rstrip()
-                    line_splitted = line.split("\t")
+        kmers = []
+        with open(self.stats_file_path, 'r') as file:
+            for line in file:
+                line = line.rstrip()
+                line_splitted = line.split("\t")
 
-                    if len(line_splitted[0]) > 0:
-                        result = subprocess.run(['iupac2meme', line_splitted[0]], capture_output=True, text=True)
-                        output.write(result.stdout)
+                # The header line starts with an empty index column
+                if len(line_splitted[0]) > 0:
+                    kmers.append(line_splitted[0])
 
-    def tomtom(self):
-        """Compares kmer motifs with database using tomtom"""
-        print_info(f"Comparing kmer motifs with database using tomtom ... ")
+        motifs_number = write_meme(kmers, self.output_meme_file_path)
+        print_info(f"{motifs_number} kmers saved to the '{os.path.basename(self.output_meme_file_path)}' file")
 
+        return kmers
+
+    def tomtom_command(self, query_file_path, output_dir):
         parameters = ['tomtom']
 
         # parameters.append('-min-overlap')
@@ -56,44 +67,110 @@ class Tomtom:
         if self.parameters['internal'] == 'yes':
             parameters.append('-internal')
 
-        if self.parameters['threshold_type'] == 'e-value':
-            parameters.append('-evalue')
-
+        # Shards report all matches; q-values depend on all of them, so the threshold is applied after merging
         parameters.append('-thresh')
-        parameters.append(self.parameters['threshold_value'])
+        parameters.append('1')
 
         parameters.append('-oc')
-        parameters.append(os.path.join(self.parameters['output_dir'], 'tomtom', 'tomtom_out'))
+        parameters.append(output_dir)
 
-        parameters.append(self.output_meme_file_path)
+        parameters.append(query_file_path)
         parameters.append(self.parameters['motif_database'])
 
-        # subprocess.run(parameters, capture_output=True, text=True)
-        process = subprocess.Popen(parameters, stderr=subprocess.PIPE)
-        while True:
-            output = process.stderr.readline().decode('utf-8').rstrip()
+        return parameters
+
+    def split_queries(self, kmers):
+        """Splits query k-mers into shards saved as separate MEME files. Returns a list of shard dictionaries."""
+        shards_number = max(min(int(self.parameters['threads_number']), len(kmers)), 1)
 
-            if output == '' and process.poll() is not None:
-                break
+        if os.path.exists(self.shards_dir):
+            shutil.rmtree(self.shards_dir)
+        os.mkdir(self.shards_dir)
+
+        shards = []
+        for i in range(shards_number):
+            shard = {
+                'meme_file': os.path.join(self.shards_dir, f'kmers_{i}.meme'),
+                'output_dir': os.path.join(self.shards_dir, f'tomtom_out_{i}')
+            }
+            write_meme(kmers[i::shards_number], shard['meme_file'])
+            shards.append(shard)
+
+        return shards
+
+    def run_shard(self, shard):
+        command = self.tomtom_command(shard['meme_file'], shard['output_dir'])
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+        return shard, command, result
+
+    def tomtom(self, kmers):
+        """Compares kmer motifs with database using tomtom.
+
+        Query motifs are split into shards compared by concurrent tomtom processes; results are merged with
+        q-values recomputed over all matches."""
+        if len(kmers) == 0:
+            print_info("There are no kmers to compare")
+            return True
 
-            if output != '':
-                try:
-                    if output[0] == 'P':
-                        print(f"\r\033[0K{output}", end='', flush=True)
-                except IndexError:
-                    print(f"DEBUG: {output}")
-                    raise IndexError
+        # Shard results are reused when the queries, the database and tomtom options did not change; the
+        # threshold is applied while merging, so changing it does not require running tomtom again
+        manifest = tomtom_manifest(self.parameters, self.stats_file_path, self.shards_dir)
+        if manifest.is_done():
+            print_info("Keeping tomtom results from the previous run")
+            results = sorted(glob.glob(os.path.join(self.shards_dir, 'tomtom_out_*', 'tomtom.tsv')))
+            print_info(f"Processing completed, {self.merge_results(results)} matches saved to: {self.output_tsv_file_path}")
+
+            return True
+
+        shards = self.split_queries(kmers)
+        print_info(f"Comparing kmer motifs with database using {len(shards)} tomtom processes ... ")
+
+        results = []
+        output = True
+
+        with ThreadPoolExecutor(len(shards)) as pool:
+            for finished, (shard, command, result) in enumerate(pool.map(self.run_shard, shards)):
+                print(f'\r\033[0K{finished + 1} / {len(shards)} shards', end='', flush=True)
+
+                if result.returncode:
+                    print("")
+                    print_warning("Something went wrong with tomtom run. Used command:")
+                    print(" ".join(command))
+                    print(result.stderr)
+                    output = False
+                    continue
+
+                results.append(os.path.join(shard['output_dir'], 'tomtom.tsv'))
 
         print("")
 
-        if not process.returncode:
-            print_info(f"Processing completed")
-            print_info(f"Report in HTML format is available at: ./output/tomtom/tomtom_out/tomtom.html")
-        else:
-            print_warning("Something went wrong with tomtom run. Used command:")
-            print(" ".join(parameters))
+        if not output:
+            return False
+
+        manifest.record()
+        matches_number = self.merge_results(results)
+
+        print_info(f"Processing completed, {matches_number} matches saved to: {self.output_tsv_file_path}")
+        print_info(f"Reports in HTML format of every shard are available in: {self.shards_dir}")
+
+        return True
+
+    def merge_results(self, result_files):
+        """Merges 'tomtom.tsv' files of shards, recomputes q-values over all matches and applies the threshold"""
+        tables = [pd.read_csv(file, sep='\t', comment='#', keep_default_na=False) for file in result_files if os.path.getsize(file) > 0]
+        data = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=TOMTOM_COLUMNS)
+
+        # Benjamini-Hochberg q-values, as computed by tomtom for a single run
+        data['q-value'] = multipletests(data['p-value'].to_numpy(dtype=float), method='fdr_bh')[1] if len(data) else []
 
-        print(" ".join(parameters))
+        threshold_column = 'E-value' if self.parameters['threshold_type'] == 'e-value' else 'q-value'
+        data = data.loc[data[threshold_column] <= float(self.parameters['threshold_value'])]
+        data = data.sort_values(['Query_ID', 'p-value'], kind='stable')
 
+        if not os.path.exists(self.output_dir):
+            os.mkdir(self.output_dir)
 
+        data.to_csv(self.output_tsv_file_path, sep='\t', index=False)
 
+        return len(data)
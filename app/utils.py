@@ -1,16 +1,178 @@
-def fasta_to_oneline(input_file_path, output_file_path):
-    with open(input_file_path, 'r') as file_in:
-        with open(output_file_path, 'w') as file_out:
-            output = ""
+import os
+import gzip
+import hashlib
+from collections import Counter
+from app.io_utils import atomic_file
+from app.chromosome_cache import ChromosomeCacheWriter, READ_CHUNK_SIZE
 
-            for line in file_in:
-                line = line.rstrip()
+FASTA_EXTENSIONS = ['.fasta', '.fa', '.fasta.gz', '.fa.gz']
 
-                if line.startswith('>'):
-                    continue
 
-                output += line
+def find_fasta_file(data_dir, file_prefix):
+    """Returns the path of the FASTA file of a prefix (plain or gzip-compressed), or None if there is none"""
+    for extension in FASTA_EXTENSIONS:
+        file_path = os.path.join(data_dir, f'{file_prefix}{extension}')
+        if os.path.exists(file_path):
+            return file_path
 
-            output += '\n'
+    return None
 
-            file_out.write(output)
+
+class HashingReader:
+    """File wrapper computing the SHA-256 checksum of the bytes read through it"""
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+
+        return data
+
+    def hexdigest(self):
+        # The rest of the file (e.g. bytes after the end of a gzip stream) is a part of the checksum too
+        for chunk in iter(lambda: self.read(1024 * 1024), b''):
+            pass
+
+        return self.digest.hexdigest()
+
+
+class RecordWriter:
+    """Writes a single FASTA record into a oneLine text file and a chromosome cache at once.
+
+    Files are written under temporary names and get the final record name in finish(), since the name depends
+    on whether the FASTA file holds one record or many."""
+
+    def __init__(self, data_dir, tmp_name, header):
+        self.data_dir = data_dir
+        self.header = header
+        self.oneline_path = os.path.join(data_dir, f'{tmp_name}_oneLine.txt.part')
+        self.cache_path = os.path.join(data_dir, f'{tmp_name}_chrom.bin.part')
+
+        self.oneline = open(self.oneline_path, 'wb')
+        self.cache = ChromosomeCacheWriter(self.cache_path)
+        self.composition = None
+
+    def write(self, sequence):
+        self.oneline.write(sequence)
+        self.cache.write(sequence)
+
+    def close(self):
+        self.oneline.write(b'\n')
+        self.oneline.close()
+        self.composition = self.cache.close()
+
+    def finish(self, name):
+        os.replace(self.oneline_path, os.path.join(self.data_dir, f'{name}_oneLine.txt'))
+        os.replace(self.cache_path, os.path.join(self.data_dir, f'{name}_chrom.bin'))
+
+        return self.composition
+
+    def discard(self):
+        for path in (self.oneline_path, self.cache_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def record_name(header):
+    """Returns the record id (the first word of the FASTA header)"""
+    words = header.decode('ascii', errors='replace').split()
+
+    return words[0] if words else ''
+
+
+def fasta_to_oneline(input_file_path, data_dir, file_prefix):
+    """Converts a FASTA file (plain or gzip-compressed) into oneLine text files and chromosome caches.
+
+    The file is streamed in fixed-size chunks. A file holding a single record is written under its prefix,
+    every record of a multi-record file is written under its own id. Returns a tuple (records, checksum), where
+    records is a list of (name, composition) pairs in the file order and checksum is the SHA-256 of the file."""
+    records = []
+    writer = None
+    header = None
+
+    with open(input_file_path, 'rb') as raw_file:
+        reader = HashingReader(raw_file)
+        stream = gzip.GzipFile(fileobj=reader) if input_file_path.endswith('.gz') else reader
+
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+
+            position = 0
+            while position < len(chunk):
+                if header is not None:
+                    # Inside a header line, which may be split between chunks
+                    line_end = chunk.find(b'\n', position)
+                    if line_end < 0:
+                        header += chunk[position:]
+                        break
+
+                    header += chunk[position:line_end].rstrip(b'\r')
+                    position = line_end + 1
+
+                    if writer is not None:
+                        writer.close()
+                    writer = RecordWriter(data_dir, f'.{file_prefix}.{len(records)}', header)
+                    records.append(writer)
+                    header = None
+                else:
+                    record_start = chunk.find(b'>', position)
+                    sequence_end = len(chunk) if record_start < 0 else record_start
+                    sequence = chunk[position:sequence_end].replace(b'\n', b'').replace(b'\r', b'')
+
+                    if len(sequence):
+                        if writer is None:
+                            # Sequence without a header line
+                            writer = RecordWriter(data_dir, f'.{file_prefix}.{len(records)}', file_prefix.encode())
+                            records.append(writer)
+                        writer.write(sequence)
+
+                    if record_start < 0:
+                        break
+
+                    header = b''
+                    position = record_start + 1
+
+        checksum = reader.hexdigest()
+
+    if header is not None:
+        # The last header line has no new line character
+        if writer is not None:
+            writer.close()
+        writer = RecordWriter(data_dir, f'.{file_prefix}.{len(records)}', header)
+        records.append(writer)
+
+    if writer is None:
+        writer = RecordWriter(data_dir, f'.{file_prefix}.0', file_prefix.encode())
+        records.append(writer)
+
+    writer.close()
+
+    if len(records) == 1:
+        names = [file_prefix]
+    else:
+        names = [record_name(record.header) for record in records]
+
+        duplicated = sorted(name for name, count in Counter(names).items() if count > 1 or name == '')
+        if duplicated:
+            for record in records:
+                record.discard()
+
+            raise ValueError(f'Records of {os.path.basename(input_file_path)} need unique, non-empty ids: {", ".join(duplicated)}')
+
+    return [(name, record.finish(name)) for name, record in zip(names, records)], checksum
+
+
+def oneline_to_fasta(oneline_file_path, fasta_file_path, name):
+    """Writes a single-record FASTA file of a oneLine chromosome, e.g. as an input of jellyfish, which reads
+    neither compressed nor multi-record files split into chromosomes"""
+    with atomic_file(fasta_file_path) as tmp_file_path, open(oneline_file_path, 'rb') as file_in:
+        with open(tmp_file_path, 'wb') as file_out:
+            file_out.write(f'>{name}\n'.encode())
+
+            for chunk in iter(lambda: file_in.read(READ_CHUNK_SIZE), b''):
+                file_out.write(chunk)
@@ -1,9 +1,9 @@
-from app.test_environment import read_config, test
+from app.test_environment import read_config, test, kmer_lengths, kmer_parameters
 
 def main():
     parameters = read_config('config.txt')
 
-    if not test():
+    if not test(parameters):
         return False
 
     from app.jellyfish_controller import jellyfish
@@ -12,28 +12,39 @@ def main():
     from app.stats_pandas import Stat
     from app.fasta_to_oneline_controller import bulk_fasta_to_oneline
     from app.tomtom_controller import Tomtom
+    from app.suffix_index import build_suffix_indexes
 
-    if not jellyfish(parameters):
+    if not bulk_fasta_to_oneline(parameters):
         return False
 
-    if not bulk_fasta_to_oneline(parameters):
+    if parameters.get('suffix_index', 'no') == 'yes' and not build_suffix_indexes(parameters):
         return False
 
     kc = kmer.KmerCounter(parameters)
-    if not kc.run():
-        return False
 
-    tm = TableMerger(parameters)
-    if not tm.run():
+    # The built-in backend counts k-mers in the same scan which classifies them
+    if parameters['counting_backend'] == 'jellyfish' and \
+            not all(jellyfish(kmer_parameters(parameters, kmer_length)) for kmer_length in kmer_lengths(parameters)):
         return False
 
-    stat = Stat(parameters)
-    if not stat.run():
+    if not kc.run():
         return False
 
-    tomtom = Tomtom(parameters)
-    if not tomtom.run():
-        return False
+    # Tables of every k-mer length are merged, tested and compared with motifs separately
+    for kmer_length in kmer_lengths(parameters):
+        k_parameters = kmer_parameters(parameters, kmer_length)
+
+        tm = TableMerger(k_parameters)
+        if not tm.run():
+            return False
+
+        stat = Stat(k_parameters)
+        if not stat.run():
+            return False
+
+        tomtom = Tomtom(k_parameters)
+        if not tomtom.run():
+            return False
 
 
 if __name__ == '__main__':
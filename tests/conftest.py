@@ -0,0 +1,184 @@
+import os
+import random
+import stat
+import sys
+import io
+import numpy as np
+import pytest
+from app.test_environment import read_config
+from app.fasta_to_oneline_controller import bulk_fasta_to_oneline
+from app.kmer_counter import KmerCounter
+from app.jellyfish_controller import jellyfish
+from app.sparse_table import SparseTable
+from app.coords_index import CoordsIndex
+
+# Stand-in for the jellyfish binary: counts (and dumps) k-mers as jellyfish does, i.e. soft-masked (lower-case)
+# bases count as the upper-case ones and windows with other characters are skipped
+JELLYFISH_STUB = '''#!{python}
+import sys
+args = sys.argv[1:]
+if args[0] == 'count':
+    kmer_length = int(args[args.index('-m') + 1])
+    sequence = ''.join(line.strip() for line in open(args[-3]) if not line.startswith('>')).upper()
+    counts = {{}}
+    for start in range(len(sequence) - kmer_length + 1):
+        kmer = sequence[start:start + kmer_length]
+        if set(kmer) <= set('ACGT'):
+            if '-C' in args:
+                kmer = min(kmer, kmer[::-1].translate(str.maketrans('ACGT', 'TGCA')))
+            counts[kmer] = counts.get(kmer, 0) + 1
+    with open(args[args.index('-o') + 1], 'w') as file:
+        for kmer, count in counts.items():
+            file.write(f'{{kmer}}\\t{{count}}\\n')
+elif args[0] == 'dump':
+    jf_file = [arg for arg in args[1:] if arg.endswith('.jf')][0]
+    with open(args[args.index('-o') + 1], 'w') as file:
+        file.write(open(jf_file).read())
+'''
+
+# Stand-in for the tomtom binary: reports five matches of every query motif with p-values derived from the
+# motif, so results do not depend on which motifs share a run. Reported q-values are meaningless on purpose.
+TOMTOM_STUB = '''#!{python}
+import os
+import sys
+import zlib
+args = sys.argv[1:]
+output_dir = args[args.index('-oc') + 1]
+os.makedirs(output_dir, exist_ok=True)
+motifs = [line.split()[1] for line in open(args[-2]) if line.startswith('MOTIF')]
+with open(os.path.join(output_dir, 'tomtom.tsv'), 'w') as file:
+    file.write('Query_ID\\tTarget_ID\\tOptimal_offset\\tp-value\\tE-value\\tq-value\\tOverlap\\tQuery_consensus\\tTarget_consensus\\tOrientation\\n')
+    for motif in motifs:
+        for target in range(5):
+            p_value = (zlib.crc32(f'{{motif}}{{target}}'.encode()) % 100000) / 1e7
+            file.write(f'{{motif}}\\tMA{{target:04d}}.1\\t0\\t{{p_value:g}}\\t{{p_value * 5:g}}\\t0.5\\t{{len(motif)}}\\t{{motif}}\\tACGTAC\\t+\\n')
+    file.write('\\n# Tomtom (Motif Comparison Tool): Version stub\\n')
+'''
+
+CONFIG = '''kmer_length={kmer_length}
+hash_size=100M
+threads_number=2
+keep_intermediate_jf_files=no
+prefixes=chr1,chr2
+output_dir={output_dir}
+data_dir={data_dir}
+keep_kmers_table=yes
+keep_kmers_merged_table=yes
+kmer_thresh_min=
+kmer_thresh_max=
+p_corrected_bon_thresh=0.05
+keep_stats_file=no
+bed_file={data_dir}/mites.bed
+run_tomtom=no
+export_tsv_tables=no
+'''
+
+FAMILIES = ['DTA', 'DTC', 'DTH', 'DTM']
+
+
+def write_genome(data_dir, lengths, soft_masked=False, seed=7):
+    """Writes random chromosomes (with runs of N and, optionally, soft-masked stretches) and a BED file of
+    MITEs, some of them overlapping the soft-masked stretches"""
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    records = []
+
+    for chr_name, length in lengths.items():
+        sequence = [rng.choice('ACGT') for _ in range(length)]
+        for _ in range(3):
+            start = rng.randrange(length - 200)
+            stop = start + rng.randint(1, 100)
+            sequence[start:stop] = ['N'] * (stop - start)
+        masked = []
+        if soft_masked:
+            for _ in range(10):
+                start = rng.randrange(length - 500)
+                stop = start + rng.randint(50, 500)
+                sequence[start:stop] = [base.lower() for base in sequence[start:stop]]
+                masked.append((start, stop))
+
+        with open(os.path.join(data_dir, f'{chr_name}.fasta'), 'w') as file:
+            file.write(f'>{chr_name} test\n')
+            for start in range(0, length, 60):
+                file.write(''.join(sequence[start:start + 60]) + '\n')
+
+        position = 100
+        while position < length - 1000:
+            position += rng.randint(200, 1500)
+            mite_length = rng.randint(80, 400)
+            records.append((chr_name, position, position + mite_length, rng.choice(FAMILIES)))
+            position += mite_length
+        for start, stop in masked:
+            records.append((chr_name, max(start - 20, 0), stop - 20, rng.choice(FAMILIES)))
+
+    with open(os.path.join(data_dir, 'mites.bed'), 'w') as file:
+        for record in sorted(records):
+            file.write('\t'.join(map(str, record)) + '\n')
+
+
+def write_config(path, data_dir, output_dir, kmer_length=5, **parameters):
+    with open(path, 'w') as file:
+        file.write(CONFIG.format(kmer_length=kmer_length, output_dir=output_dir, data_dir=data_dir))
+        for key, value in parameters.items():
+            file.write(f'{key}={value}\n')
+
+    return path
+
+
+def count_tables(config_file, backend, **overrides):
+    """Runs the counting stage with the given backend. Returns a tuple (parameters, {chromosome: table})."""
+    parameters = read_config(config_file)
+    parameters['counting_backend'] = backend
+    parameters.update(overrides)
+    assert bulk_fasta_to_oneline(parameters)
+
+    if backend == 'jellyfish':
+        assert jellyfish(parameters)
+    assert KmerCounter(parameters).run()
+
+    tables_dir = os.path.join(parameters['output_dir'], 'tables')
+    return parameters, {prefix: SparseTable.load(os.path.join(tables_dir, f'table_{prefix}.sparse'))
+                        for prefix in parameters['prefixes']}
+
+
+def read_coords(parameters, prefix):
+    """Returns the coordinates of a chromosome as TSV text"""
+    text = io.StringIO()
+    CoordsIndex.load(os.path.join(parameters['output_dir'], 'tables', f'table_{prefix}.coords')).write_tsv(text)
+
+    return text.getvalue()
+
+
+def assert_same_tables(tables, expected):
+    for prefix, table in expected.items():
+        assert np.array_equal(np.asarray(tables[prefix].codes), np.asarray(table.codes))
+        assert np.array_equal(np.asarray(tables[prefix].totals), np.asarray(table.totals))
+        assert np.array_equal(tables[prefix].to_dense(), table.to_dense())
+
+
+@pytest.fixture
+def install_stub(tmp_path, monkeypatch):
+    """Returns a function installing an executable stand-in (source formatted with the Python interpreter path)
+    first on PATH"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def install(name, source):
+        stub = bin_dir / name
+        stub.write_text(source.format(python=sys.executable))
+        stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+
+        return stub
+
+    return install
+
+
+@pytest.fixture
+def jellyfish_stub(install_stub):
+    return install_stub('jellyfish', JELLYFISH_STUB)
+
+
+@pytest.fixture
+def tomtom_stub(install_stub):
+    return install_stub('tomtom', TOMTOM_STUB)
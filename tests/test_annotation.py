@@ -0,0 +1,60 @@
+from collections import Counter
+import numpy as np
+from app.annotation import AnnotationIndex
+
+FAMILY_NAMES = ['DTA', 'DTC', 'DTH']
+
+
+def brute_force(begins, ends, families, positions, kmer_length, index):
+    """Classifies occurrences one by one as the baseline worker did with its interval tree: a window overlaps the
+    MITEs hit by the query [position, position + kmer_length + 1) and lies inside a MITE if it starts at
+    begin - 1 or later and ends at the MITE end or earlier. Returns (counted (occurrence, column) pairs,
+    (occurrence, MITE) pairs inside MITEs, occurrences overlapping several MITEs)."""
+    # The interval tree keeps identical intervals once and ignores empty ones
+    mites = sorted({(begin, end, family) for begin, end, family in zip(begins, ends, families) if begin < end})
+    counts = Counter()
+    inside = set()
+    multiple = set()
+
+    for occurrence, position in enumerate(positions):
+        hits = [mite for mite in mites if mite[0] < position + kmer_length + 1 and mite[1] > position]
+
+        if len(hits) == 0:
+            counts[occurrence, index.genome_column] += 1
+        elif len(hits) == 1 and position >= hits[0][0] - 1 and position + kmer_length <= hits[0][1]:
+            counts[occurrence, index.family_columns[hits[0][2]]] += 1
+            inside.add((occurrence, hits[0]))
+        else:
+            # More than two overlapping MITEs stopped the baseline worker; they are edge hits of every MITE now
+            if len(hits) > 1:
+                multiple.add(occurrence)
+            for mite in hits:
+                counts[occurrence, index.edge_column] += 1
+                counts[occurrence, index.family_edge_columns[mite[2]]] += 1
+
+    return counts, inside, multiple
+
+
+def test_classify_matches_the_interval_tree_worker():
+    rng = np.random.default_rng(9)
+    begins = rng.integers(0, 2000, 150)
+    ends = begins + rng.integers(0, 60, 150)
+    families = rng.integers(0, len(FAMILY_NAMES), 150)
+    # MITEs touching each other, identical ones and an empty one
+    begins = np.concatenate((begins, [500, 530, 700, 700, 900]))
+    ends = np.concatenate((ends, [530, 560, 750, 750, 900]))
+    families = np.concatenate((families, [0, 1, 2, 2, 0]))
+
+    index = AnnotationIndex(begins, ends, families, FAMILY_NAMES)
+    positions = np.arange(0, 2100)
+
+    for kmer_length in (1, 5, 12):
+        occurrences, columns, inside, inside_mites, multiple = index.classify(positions, kmer_length)
+        expected_counts, expected_inside, expected_multiple = brute_force(begins.tolist(), ends.tolist(), families.tolist(),
+                                                                          positions.tolist(), kmer_length, index)
+
+        assert Counter(zip(occurrences.tolist(), columns.tolist())) == expected_counts
+        assert {(occurrence, (int(index.begins[mite]), int(index.ends[mite]), int(index.families[mite])))
+                for occurrence, mite in zip(inside.tolist(), inside_mites.tolist())} == expected_inside
+        assert set(multiple.tolist()) == expected_multiple
+        assert any(len(index.mites_at(position, kmer_length)) > 2 for position in multiple.tolist())
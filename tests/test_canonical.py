@@ -0,0 +1,50 @@
+import numpy as np
+from conftest import write_genome, write_config, count_tables, read_coords, assert_same_tables
+from app.kmer_codes import codes_to_kmers, reverse_complement
+
+
+def rows_by_kmer(table):
+    dense = table.to_dense()
+    return {kmer: (total, dense[row]) for row, (kmer, total) in
+            enumerate(zip(codes_to_kmers(table.codes, table.kmer_length), np.asarray(table.totals).tolist()))}
+
+
+def test_canonical_tables(tmp_path, jellyfish_stub):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 8000, 'chr2': 5000})
+
+    # Even k-mer lengths have palindromes, which are their own reverse complements
+    for kmer_length in (4, 5):
+        def config(name, **parameters):
+            return write_config(str(tmp_path / f'{name}{kmer_length}.txt'), data_dir, str(tmp_path / f'{name}{kmer_length}'),
+                                kmer_length=kmer_length, **parameters)
+
+        parameters, tables = count_tables(config('builtin', canonical_kmers='yes'), 'builtin')
+        jellyfish_parameters, jellyfish_tables = count_tables(config('jellyfish', canonical_kmers='yes'), 'jellyfish')
+        _, forward_tables = count_tables(config('forward'), 'builtin')
+
+        assert_same_tables(tables, jellyfish_tables)
+        for prefix in parameters['prefixes']:
+            assert read_coords(parameters, prefix) == read_coords(jellyfish_parameters, prefix)
+
+        palindromes = 0
+        for prefix, table in tables.items():
+            assert table.columns == forward_tables[prefix].columns
+            canonical = rows_by_kmer(table)
+            forward = rows_by_kmer(forward_tables[prefix])
+            zero = (0, np.zeros(len(table.columns), dtype=np.int64))
+
+            assert set(canonical) == {min(kmer, reverse_complement(kmer)) for kmer in forward}
+            for kmer, (total, counts) in canonical.items():
+                complement = reverse_complement(kmer)
+                if complement == kmer:
+                    palindromes += 1
+                    expected_total, expected_counts = forward[kmer]
+                else:
+                    expected_total = forward.get(kmer, zero)[0] + forward.get(complement, zero)[0]
+                    expected_counts = forward.get(kmer, zero)[1] + forward.get(complement, zero)[1]
+
+                assert total == expected_total
+                assert np.array_equal(counts, expected_counts)
+
+        assert (palindromes > 0) == (kmer_length % 2 == 0)
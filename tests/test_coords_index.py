@@ -0,0 +1,33 @@
+import io
+import numpy as np
+from app.coords_index import write_coords_run, build_coords_index, CoordsIndex
+from app.kmer_codes import codes_to_kmers
+
+
+def test_runs_join_into_coords_of_counted_kmers(tmp_path):
+    rng = np.random.default_rng(3)
+    run_dir = tmp_path / 'table_chr1.coords.runs'
+    run_dir.mkdir()
+
+    shards = []
+    for shard_start in (0, 1000, 2000):
+        codes = rng.integers(0, 16, 50).astype(np.uint32)
+        begins = rng.integers(shard_start, shard_start + 1000, 50)
+        shards.append((codes, begins, begins + 100, rng.integers(0, 2, 50)))
+        write_coords_run(str(run_dir), shard_start, *shards[-1])
+
+    kmer_codes = np.arange(0, 16, 2, dtype=np.uint32)
+    build_coords_index(str(run_dir), str(tmp_path / 'table_chr1.coords'), 2, 'chr1', ['DTA', 'DTC'], kmer_codes)
+    assert not run_dir.exists()
+
+    # Records of a k-mer follow the order of the shards, as if all of them were written at once
+    codes, begins, ends, families = [np.concatenate(arrays) for arrays in zip(*shards)]
+    expected = io.StringIO()
+    for code in kmer_codes:
+        kmer = codes_to_kmers(np.array([code]), 2)[0]
+        for i in np.flatnonzero(codes == code):
+            expected.write(f"chr1\t{begins[i]}\t{ends[i]}\t{kmer};{['DTA', 'DTC'][families[i]]}\n")
+
+    written = io.StringIO()
+    CoordsIndex.load(str(tmp_path / 'table_chr1.coords')).write_tsv(written)
+    assert written.getvalue() == expected.getvalue()
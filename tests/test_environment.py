@@ -0,0 +1,17 @@
+import os
+from app.test_environment import read_config, kmer_lengths, kmer_parameters
+from conftest import write_config
+
+
+def test_kmer_lengths_share_the_cache_directory(tmp_path):
+    output_dir = str(tmp_path / 'out')
+    parameters = read_config(write_config(str(tmp_path / 'config.txt'), str(tmp_path / 'data'), output_dir,
+                                          kmer_length='7,5'))
+
+    assert kmer_lengths(parameters) == [5, 7]
+    for kmer_length in kmer_lengths(parameters):
+        k_parameters = kmer_parameters(parameters, kmer_length)
+
+        assert k_parameters['output_dir'] == os.path.join(output_dir, f'k{kmer_length}')
+        assert k_parameters['cache_dir'] == os.path.join(output_dir, 'cache')
+        assert k_parameters['jellyfish_fasta_dir'] == os.path.join(output_dir, 'jellyfish')
@@ -0,0 +1,54 @@
+import numpy as np
+import scipy.stats
+from app.fisher_test import fisher_exact, PValueCache
+
+
+def scipy_pvalues(tables):
+    return np.array([scipy.stats.fisher_exact([[c00, c01], [c10, c11]])[1] for c00, c01, c10, c11 in tables.tolist()])
+
+
+def random_tables(rng):
+    tables = [rng.integers(0, 20, (300, 4)), rng.integers(0, 2000, (300, 4)),
+              # Counts as in genome-wide tables: few occurrences in MITEs against chromosome lengths
+              np.stack((rng.integers(0, 50, 200), rng.integers(10 ** 6, 10 ** 9, 200),
+                        rng.integers(0, 5000, 200), rng.integers(10 ** 6, 10 ** 9, 200)), axis=1)]
+
+    # Tables with a zero row or column
+    zeros = rng.integers(0, 100, (40, 4))
+    zeros[:10, [0, 1]] = 0
+    zeros[10:20, [2, 3]] = 0
+    zeros[20:30, [0, 2]] = 0
+    zeros[30:, [1, 3]] = 0
+    tables.append(zeros)
+
+    return np.concatenate(tables)
+
+
+def test_pvalues_match_scipy():
+    tables = random_tables(np.random.default_rng(5))
+
+    assert np.array_equal(fisher_exact(*tables.T), scipy_pvalues(tables))
+
+
+def test_cache_tests_every_table_once(tmp_path):
+    rng = np.random.default_rng(6)
+    tables = rng.integers(0, 10, (500, 4))
+    cache_file = str(tmp_path / 'fisher_pvalues.npz')
+
+    cache = PValueCache(cache_file)
+    pvalues = cache.fisher_exact(*tables.T)
+    assert np.array_equal(pvalues, fisher_exact(*tables.T))
+    assert cache.queries == 500
+    assert cache.unique_tables == len(np.unique(tables, axis=0))
+    assert cache.cache_hits == 0
+    cache.save()
+
+    # A reloaded cache answers the same tables without testing them and tests only the new ones
+    reloaded = PValueCache(cache_file)
+    new_tables = np.concatenate((tables[:100], rng.integers(10, 20, (50, 4))))
+    assert np.array_equal(reloaded.fisher_exact(*new_tables.T), fisher_exact(*new_tables.T))
+
+    old_unique = len(np.unique(tables[:100], axis=0))
+    assert reloaded.unique_tables == len(np.unique(new_tables, axis=0))
+    assert reloaded.cache_hits == old_unique
+    assert f'hit rate {old_unique / reloaded.unique_tables:.2%}' in reloaded.report()
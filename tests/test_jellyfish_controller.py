@@ -0,0 +1,35 @@
+import threading
+import time
+from app import jellyfish_controller
+from app.test_environment import read_config
+from app.fasta_to_oneline_controller import bulk_fasta_to_oneline
+from conftest import write_genome, write_config
+
+
+def test_jobs_stay_within_thread_budget(tmp_path, monkeypatch):
+    data_dir = str(tmp_path / 'data')
+    prefixes = ['chr1', 'chr2', 'chr3', 'chr4', 'chr5']
+    write_genome(data_dir, {prefix: 3000 for prefix in prefixes})
+    parameters = read_config(write_config(str(tmp_path / 'config.txt'), data_dir, str(tmp_path / 'out'),
+                                          threads_number=4, prefixes=','.join(prefixes)))
+    assert bulk_fasta_to_oneline(parameters)
+
+    lock = threading.Lock()
+    usage = {'threads': 0, 'peak': 0}
+
+    def run_streaming(command, header):
+        threads = int(command[command.index('-t') + 1]) if command[1] == 'count' else 1
+        with lock:
+            usage['threads'] += threads
+            usage['peak'] = max(usage['peak'], usage['threads'])
+        time.sleep(0.05)
+        open(command[command.index('-o') + 1], 'w').close()
+        with lock:
+            usage['threads'] -= threads
+
+        return 0, []
+
+    monkeypatch.setattr(jellyfish_controller, 'run_streaming', run_streaming)
+
+    assert jellyfish_controller.jellyfish(parameters)
+    assert usage['peak'] <= 4
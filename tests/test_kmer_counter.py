@@ -0,0 +1,51 @@
+import os
+from conftest import write_genome, write_config, count_tables, read_coords, assert_same_tables
+from app.tables_merger import TableMerger
+
+
+def write_bed(data_dir, records):
+    with open(os.path.join(data_dir, 'mites.bed'), 'w') as file:
+        for record in records:
+            file.write('\t'.join(map(str, record)) + '\n')
+
+
+def test_shards_without_mite_hits(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 20000, 'chr2': 15000})
+    # MITEs cover the first 8 kbp of chr1 only, so every other shard has no occurrences inside MITEs
+    write_bed(data_dir, [('chr1', begin, begin + 300, 'DTA') for begin in range(500, 8000, 1000)])
+
+    expected_parameters, expected = count_tables(write_config(str(tmp_path / 'single.txt'), data_dir,
+                                                              str(tmp_path / 'single')), 'builtin')
+    parameters, tables = count_tables(write_config(str(tmp_path / 'sharded.txt'), data_dir, str(tmp_path / 'sharded'),
+                                                   shard_size=10000), 'builtin')
+
+    assert_same_tables(tables, expected)
+    for prefix in parameters['prefixes']:
+        assert read_coords(parameters, prefix) == read_coords(expected_parameters, prefix)
+    assert read_coords(parameters, 'chr2') == ''
+
+
+def test_tsv_export_of_kept_tables(tmp_path, capsys):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 8000, 'chr2': 5000})
+    config_file = write_config(str(tmp_path / 'kept.txt'), data_dir, str(tmp_path / 'kept'))
+    parameters, _ = count_tables(config_file, 'builtin')
+    assert TableMerger(parameters).run()
+    capsys.readouterr()
+
+    # Turning the export on keeps the counted tables and exports them
+    parameters, _ = count_tables(config_file, 'builtin', export_tsv_tables='yes')
+    assert TableMerger(parameters).run()
+    output = capsys.readouterr().out
+    assert 'Keeping k-mer counting of chr1 from the previous run' in output
+    assert 'Keeping merged table from the previous run' in output
+
+    expected_parameters, _ = count_tables(write_config(str(tmp_path / 'exported.txt'), data_dir, str(tmp_path / 'exported'),
+                                                       export_tsv_tables='yes'), 'builtin')
+    assert TableMerger(expected_parameters).run()
+
+    for name in ['table_chr1', 'table_chr1_coords.txt', 'table_chr2', 'table_chr2_coords.txt', 'table_merged.txt']:
+        with open(os.path.join(parameters['output_dir'], 'tables', name)) as file, \
+                open(os.path.join(expected_parameters['output_dir'], 'tables', name)) as expected:
+            assert file.read() == expected.read()
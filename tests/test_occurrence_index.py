@@ -0,0 +1,43 @@
+import os
+import random
+from conftest import write_config, count_tables, read_coords, assert_same_tables
+
+
+def write_data(data_dir, seed):
+    """Writes chromosomes with an N run covering whole shards and a BED file of random MITEs"""
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+
+    sequences = {'chr1': [rng.choice('ACGT') for _ in range(30000)], 'chr2': [rng.choice('ACGT') for _ in range(12000)]}
+    sequences['chr1'][9000:21000] = ['N'] * 12000
+    for chr_name, sequence in sequences.items():
+        with open(os.path.join(data_dir, f'{chr_name}.fasta'), 'w') as file:
+            file.write(f'>{chr_name}\n' + ''.join(sequence) + '\n')
+
+    write_bed(data_dir, rng)
+
+
+def write_bed(data_dir, rng):
+    with open(os.path.join(data_dir, 'mites.bed'), 'w') as file:
+        for chr_name, length in (('chr1', 30000), ('chr2', 12000)):
+            for begin in sorted(rng.sample(range(0, length - 500), 25)):
+                file.write(f"{chr_name}\t{begin}\t{begin + rng.randint(50, 400)}\t{rng.choice(['DTA', 'DTC', 'DTH'])}\n")
+
+
+def test_new_annotation_from_the_index_matches_a_scan(tmp_path, capsys):
+    data_dir = str(tmp_path / 'data')
+    write_data(data_dir, 11)
+    config_file = write_config(str(tmp_path / 'index.txt'), data_dir, str(tmp_path / 'index'), shard_size=5000,
+                               occurrence_index='yes')
+    count_tables(config_file, 'builtin')
+
+    write_bed(data_dir, random.Random(12))
+    capsys.readouterr()
+    parameters, tables = count_tables(config_file, 'builtin')
+    assert 'Classifying k-mer occurrences of chr1 from the occurrence index' in capsys.readouterr().out
+
+    expected_parameters, expected = count_tables(write_config(str(tmp_path / 'scan.txt'), data_dir, str(tmp_path / 'scan')), 'builtin')
+
+    assert_same_tables(tables, expected)
+    for prefix in parameters['prefixes']:
+        assert read_coords(parameters, prefix) == read_coords(expected_parameters, prefix)
@@ -0,0 +1,22 @@
+import os
+import numpy as np
+from app.jellyfish_dump import load_dump
+from conftest import write_genome, write_config, count_tables, assert_same_tables
+
+
+def test_soft_masked_totals_match_between_backends(tmp_path, jellyfish_stub):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 20000, 'chr2': 15000}, soft_masked=True)
+
+    _, builtin_tables = count_tables(write_config(str(tmp_path / 'builtin.txt'), data_dir, str(tmp_path / 'builtin')), 'builtin')
+    parameters, jellyfish_tables = count_tables(write_config(str(tmp_path / 'jellyfish.txt'), data_dir, str(tmp_path / 'jellyfish')), 'jellyfish')
+
+    for prefix in parameters['prefixes']:
+        builtin_table, jellyfish_table = builtin_tables[prefix], jellyfish_tables[prefix]
+
+        # The dump counts soft-masked k-mers too, so its totals are higher than the ones in the tables
+        dump_codes, dump_totals = load_dump(os.path.join(parameters['jellyfish_out_dir'], f'{prefix}_dump.tsv'), 5)
+        assert np.array_equal(dump_codes, np.asarray(jellyfish_table.codes))
+        assert np.any(dump_totals > np.asarray(jellyfish_table.totals))
+
+    assert_same_tables(builtin_tables, jellyfish_tables)
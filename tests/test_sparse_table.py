@@ -0,0 +1,53 @@
+import os
+from conftest import write_genome, write_config, count_tables
+
+
+def old_table(parameters, prefix, kmers):
+    """Writes the rows of a chromosome table as the baseline worker did: occurrences are found with str.find and
+    classified against the MITEs hit by the window [occurrence, occurrence + k + 1)"""
+    kmer_length = int(parameters['kmer_length'])
+    with open(os.path.join(parameters['data_dir'], f'{prefix}_oneLine.txt')) as file:
+        chromosome = file.read()
+    with open(parameters['bed_file']) as file:
+        mites = [line.rstrip().split('\t') for line in file]
+
+    mite_names = sorted({mite[3] for mite in mites} | {mite[3] + '_edge' for mite in mites})
+    chr_mites = [(int(mite[1]), int(mite[2]), mite[3]) for mite in mites if mite[0] == prefix]
+    lines = ['\t'.join(['k-mer', f'total_occurences_in_{prefix}'] + mite_names + ['edge', 'genome'])]
+
+    for kmer in kmers:
+        counts = dict.fromkeys(mite_names + ['edge', 'genome'], 0)
+        occurrences = [position for position in range(len(chromosome)) if chromosome.startswith(kmer, position)]
+
+        for position in occurrences:
+            hits = [mite for mite in chr_mites if mite[0] < position + kmer_length + 1 and mite[1] > position]
+            if len(hits) == 0:
+                counts['genome'] += 1
+            elif len(hits) == 1 and position >= hits[0][0] - 1 and position + kmer_length <= hits[0][1]:
+                counts[hits[0][2]] += 1
+            else:
+                for mite in hits:
+                    counts['edge'] += 1
+                    counts[mite[2] + '_edge'] += 1
+
+        lines.append('\t'.join([kmer, str(len(occurrences))] + [str(counts[name]) for name in mite_names + ['edge', 'genome']]))
+
+    return lines
+
+
+def test_export_tsv_writes_the_old_layout(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 6000, 'chr2': 4000})
+    parameters, tables = count_tables(write_config(str(tmp_path / 'config.txt'), data_dir, str(tmp_path / 'output'),
+                                                   kmer_length=4), 'builtin')
+
+    for prefix, table in tables.items():
+        tsv_file = str(tmp_path / f'table_{prefix}')
+        table.export_tsv(tsv_file, chunk_rows=50)
+        with open(tsv_file) as file:
+            lines = file.read().splitlines()
+
+        kmers = [line.split('\t')[0] for line in lines[1:]]
+        # Rows come in k-mer code order, i.e. sorted alphabetically
+        assert kmers == sorted(kmers) and len(kmers) == len(table)
+        assert lines == old_table(parameters, prefix, kmers)
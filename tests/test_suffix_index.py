@@ -0,0 +1,36 @@
+import re
+import numpy as np
+from app.kmer_codes import encode_sequence
+from app.suffix_index import SuffixIndex, suffix_array, build_suffix_indexes
+from app.test_environment import read_config
+from app.fasta_to_oneline_controller import bulk_fasta_to_oneline
+from app.kmer_counter import KmerCounter
+from conftest import write_genome, write_config
+
+SEQUENCE = 'ACGTacgtACGTNNACGTTacgTACGT'
+
+
+def test_queries_are_case_insensitive():
+    encoded = encode_sequence(SEQUENCE)
+    index = SuffixIndex('chr1', encoded, suffix_array(encoded))
+
+    # Soft-masked positions never match, whatever the case of the query
+    expected = [match.start() for match in re.finditer('(?=ACGT)', SEQUENCE)]
+    assert index.locate('ACGT').tolist() == expected
+    assert index.locate('acgt').tolist() == expected
+    assert index.count('AcGt') == len(expected)
+
+
+def test_count_kmers_accepts_lower_case_kmers(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 5000, 'chr2': 4000}, soft_masked=True)
+    parameters = read_config(write_config(str(tmp_path / 'config.txt'), data_dir, str(tmp_path / 'out')))
+    assert bulk_fasta_to_oneline(parameters)
+    assert build_suffix_indexes(parameters)
+
+    table = KmerCounter(parameters).count_kmers(['acgtac', 'ACGTAC', 'ttGGa'])
+
+    assert table.index.tolist() == ['ACGTAC', 'TTGGA']
+    upper = KmerCounter(parameters).count_kmers(['ACGTAC', 'TTGGA'])
+    assert np.array_equal(table.to_numpy(), upper.to_numpy())
+    assert table.loc['ACGTAC', 'total_occurences'] > 0
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from conftest import write_genome, write_config, count_tables
+from app.tables_merger import TableMerger
+from app.sparse_table import SparseTable, merge_streaming
+
+
+def text_merge(paths):
+    """Merges TSV tables as the text merger did: rows are summed per k-mer and sorted by k-mer. The text merger
+    wrote the header of the last table it read in directory order; the header of the first table is kept here."""
+    header = None
+    merged = {}
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                fields = line.rstrip().split('\t')
+                if fields[0] == 'k-mer':
+                    header = line.rstrip() if header is None else header
+                    continue
+                merged[fields[0]] = merged.get(fields[0], 0) + np.array(list(map(int, fields[1:])))
+
+    return [header] + [kmer + '\t' + '\t'.join(map(str, merged[kmer])) for kmer in sorted(merged)]
+
+
+def test_merge_modes_give_the_same_table(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    write_genome(data_dir, {'chr1': 12000, 'chr2': 9000, 'chr3': 3000})
+    parameters, tables = count_tables(write_config(str(tmp_path / 'config.txt'), data_dir, str(tmp_path / 'output'),
+                                                   prefixes='chr1,chr2,chr3', keep_kmers_merged_table='no',
+                                                   export_tsv_tables='yes'), 'builtin')
+    tables_dir = os.path.join(parameters['output_dir'], 'tables')
+
+    merged = {}
+    for merge_mode in ('memory', 'dense', 'streaming'):
+        assert TableMerger(dict(parameters, merge_mode=merge_mode)).run()
+        merged[merge_mode] = SparseTable.load(os.path.join(tables_dir, 'table_merged.sparse'))
+
+        with open(os.path.join(tables_dir, 'table_merged.txt')) as file:
+            assert file.read().splitlines() == text_merge([os.path.join(tables_dir, f'table_{prefix}')
+                                                           for prefix in parameters['prefixes']])
+
+    # Chunk boundaries fall inside the tables
+    tables = list(tables.values())
+    merged['dense chunks'] = SparseTable.merge_dense(tables, chunk_rows=7)
+    merge_streaming(tables, str(tmp_path / 'streaming.sparse'), chunk_rows=7)
+    merged['streaming chunks'] = SparseTable.load(str(tmp_path / 'streaming.sparse'))
+
+    expected = merged.pop('memory')
+    assert expected.columns == tables[0].columns
+    for table in merged.values():
+        assert table.columns == expected.columns and table.total_column == expected.total_column
+        assert np.array_equal(np.asarray(table.codes), np.asarray(expected.codes))
+        assert np.array_equal(np.asarray(table.totals), np.asarray(expected.totals))
+        assert np.array_equal(np.asarray(table.indptr), np.asarray(expected.indptr))
+        assert np.array_equal(np.asarray(table.indices), np.asarray(expected.indices))
+        assert np.array_equal(np.asarray(table.data), np.asarray(expected.data))
@@ -0,0 +1,70 @@
+import glob
+import itertools
+import os
+import pandas as pd
+from statsmodels.stats.multitest import multipletests
+from app.tomtom_controller import Tomtom
+
+KMERS = [''.join(bases) for bases in itertools.product('ACGT', repeat=4)][:60]
+
+
+def run_tomtom(tmp_path, name, threads_number, threshold_value):
+    output_dir = tmp_path / name
+    (output_dir / 'stats').mkdir(parents=True, exist_ok=True)
+    with open(output_dir / 'stats' / 'stats_filtered_3_by_freq_lesser.txt', 'w') as file:
+        file.write('\tp_value\n')
+        for kmer in KMERS:
+            file.write(f'{kmer}\t0.001\n')
+
+    database = tmp_path / 'motifs.meme'
+    database.write_text('MEME version 4\n')
+
+    parameters = {
+        'output_dir': str(output_dir),
+        'threads_number': str(threads_number),
+        'run_tomtom': 'yes',
+        'motif_database': str(database),
+        'min_overlap': '1',
+        'internal': 'no',
+        'threshold_type': 'q-value',
+        'threshold_value': str(threshold_value)
+    }
+    tomtom = Tomtom(parameters)
+    assert tomtom.run()
+
+    return tomtom
+
+
+def test_shards_merge_like_a_single_run(tmp_path, tomtom_stub):
+    single = run_tomtom(tmp_path, 'single', 1, 0.005)
+    sharded = run_tomtom(tmp_path, 'sharded', 4, 0.005)
+
+    assert len(glob.glob(os.path.join(sharded.shards_dir, 'tomtom_out_*'))) == 4
+    assert open(single.output_tsv_file_path).read() == open(sharded.output_tsv_file_path).read()
+
+
+def test_q_values_are_computed_over_all_shards(tmp_path, tomtom_stub):
+    tomtom = run_tomtom(tmp_path, 'sharded', 4, 0.005)
+
+    matches = pd.concat([pd.read_csv(file, sep='\t', comment='#')
+                         for file in glob.glob(os.path.join(tomtom.shards_dir, 'tomtom_out_*', 'tomtom.tsv'))])
+    matches['q-value'] = multipletests(matches['p-value'].to_numpy(dtype=float), method='fdr_bh')[1]
+    expected = matches.loc[matches['q-value'] <= 0.005].set_index(['Query_ID', 'Target_ID']).sort_index()
+
+    merged = pd.read_csv(tomtom.output_tsv_file_path, sep='\t').set_index(['Query_ID', 'Target_ID']).sort_index()
+
+    # The threshold keeps a part of the matches, so it is applied to the recomputed q-values
+    assert 0 < len(merged) < len(matches)
+    assert merged.index.equals(expected.index)
+    assert (merged['q-value'] - expected['q-value']).abs().max() < 1e-12
+
+
+def test_results_are_kept_with_another_number_of_threads(tmp_path, tomtom_stub, capsys):
+    sharded = run_tomtom(tmp_path, 'sharded', 4, 0.005)
+    expected = open(sharded.output_tsv_file_path).read()
+    capsys.readouterr()
+
+    # Tomtom is not run again, the four kept shards are merged
+    kept = run_tomtom(tmp_path, 'sharded', 2, 0.005)
+    assert 'Keeping tomtom results from the previous run' in capsys.readouterr().out
+    assert open(kept.output_tsv_file_path).read() == expected